@@ -2,13 +2,10 @@
 # requires-python = ">=3.11"
 # dependencies = [
 #     "httpx",
-#     "pandas",
-#     "beautifulsoup4",
 #     "pyyaml",
 #     "python-dotenv",
 #     "pyperclip",
 #     "lxml",
-#     "markdown",
 # ]
 # ///
 """Prepare an Eleventy blog post for cross-posting to Substack.
@@ -20,25 +17,70 @@ and Nunjucks syntax so the output pastes cleanly into Substack's editor.
 from __future__ import annotations
 
 import argparse
+import base64
+import bisect
+import contextlib
+import csv
+import functools
+import glob
+import hashlib
+import html
 import io
 import json
 import os
 import re
+import shutil
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
 from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO, Callable, Iterable, Iterator, Sequence, TextIO
 
 import subprocess
 import webbrowser
 
-import httpx
-import markdown as md_lib
-import pandas as pd
-import yaml
-from bs4 import BeautifulSoup
-from dotenv import load_dotenv
+# Third-party modules, and the slower stdlib ones (concurrent.futures,
+# email.utils, html.parser), are imported by the stages that use them, so a
+# dry run never pays for httpx (see STARTUP_BUDGET in substack_prep_dev.py).
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+    import httpx
 
 SITE_URL = "https://tristinb.github.io"
-DW_API = "https://api.datawrapper.de/v3"
+# Both can be pointed elsewhere from the environment, e.g. at the stand-in
+# from substack_prep_dev.py --fake-datawrapper
+DW_API = os.environ.get("DATAWRAPPER_API", "https://api.datawrapper.de/v3")
+# Output naming used by @11ty/eleventy-img with the options in eleventy.config.images.js
+ELEVENTY_IMG_URL_PATH = "/img/"
+ELEVENTY_IMG_HASH_LENGTH = 10
+ELEVENTY_IMG_HASH_OPTIONS = json.dumps(
+    {key: {} for key in sorted([
+        "sharpOptions", "sharpWebpOptions", "sharpPngOptions", "sharpJpegOptions", "sharpAvifOptions",
+    ])},
+    separators=(",", ":"),
+)
+DW_CONCURRENCY = 4
+
+DW_MAX_BACKOFF = 30.0
+# Largest table sent to Datawrapper; bigger ones fail before any upload
+DW_MAX_ROWS = int(os.environ.get("DATAWRAPPER_MAX_ROWS") or 30_000)
+# Table CSVs stay in memory up to this size, then spill to a temp file
+SPOOL_MAX_BYTES = 1 << 20
+SERVE_ADDRESS = "127.0.0.1:8765"
+OUTPUT_FORMATS = ("md", "html", "both")
+PROJECT_ROOT = Path(__file__).resolve().parent
+BLOG_DIR = PROJECT_ROOT / "content" / "blog"
+CHART_CACHE_DB = Path(os.environ.get("SUBSTACK_CHART_CACHE") or PROJECT_ROOT / ".substack_charts.sqlite")
+CATALOG_DB = Path(os.environ.get("SUBSTACK_CATALOG") or PROJECT_ROOT / ".substack_catalog.sqlite")
+MATH_DPI = 200
+# Substack's content column is 728 px; variants are capped at 2x for retina
+IMAGE_MAX_WIDTH = 1456
+IMAGE_QUALITY = 85
 
 
 # ---------------------------------------------------------------------------
@@ -49,7 +91,148 @@ def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Prepare a blog post for Substack cross-posting.",
     )
-    parser.add_argument("post", type=Path, help="Path to the .md post file")
+    parser.add_argument(
+        "posts",
+        nargs="*",
+        metavar="post",
+        help="Path(s) or glob(s) of .md post files",
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Convert every post under content/blog",
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Worker processes for batch mode (default: CPU count)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DW_CONCURRENCY,
+        help=f"Parallel Datawrapper uploads per post (default: {DW_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--changed-since",
+        type=since_timestamp,
+        metavar="WHEN",
+        help="Only posts whose content changed since WHEN (ISO date/time, or an age like 7d, 12h)",
+    )
+    parser.add_argument(
+        "--stale",
+        action="store_true",
+        help="Only posts changed since they were last prepped without --dry-run (or never were)",
+    )
+    parser.add_argument(
+        "--tag",
+        action="append",
+        help="Only posts with this frontmatter tag (repeatable: any of them)",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="List the selected posts with their catalog status instead of converting them",
+    )
+    parser.add_argument(
+        "--migrate-cache",
+        action="store_true",
+        help="Import per-post _datawrapper.json caches into the shared chart cache",
+    )
+    parser.add_argument(
+        "--evict-older-than",
+        type=float,
+        metavar="DAYS",
+        help="Drop chart cache entries created more than DAYS ago",
+    )
+    parser.add_argument(
+        "--evict-unused",
+        type=float,
+        metavar="DAYS",
+        help="Drop chart cache entries not used in the last DAYS",
+    )
+    parser.add_argument(
+        "--gc-orphans",
+        nargs="?",
+        const="list",
+        choices=["list", "delete"],
+        help="List (or delete) Datawrapper charts created but never recorded as published",
+    )
+    parser.add_argument(
+        "--render-math",
+        nargs="?",
+        const="png",
+        choices=MATH_FORMATS,
+        help="Render formulas to local images instead of [LATEX: ...] markers (default format: png)",
+    )
+    parser.add_argument(
+        "--math-renderer",
+        choices=sorted(MATH_RENDERERS),
+        default="mathtext",
+        help="Formula renderer for --render-math (default: mathtext, needs matplotlib)",
+    )
+    parser.add_argument(
+        "--optimize-images",
+        action="store_true",
+        help="Store width-capped, recompressed image variants in the --export bundle (needs Pillow)",
+    )
+    parser.add_argument(
+        "--max-image-width",
+        type=int,
+        default=IMAGE_MAX_WIDTH,
+        help=f"Width cap for --optimize-images (default: {IMAGE_MAX_WIDTH})",
+    )
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="both",
+        help="Outputs to write: md, html or both (default: both)",
+    )
+    parser.add_argument(
+        "--export",
+        type=Path,
+        metavar="ZIP",
+        help="Also bundle every converted post's HTML, metadata and local images into one import archive",
+    )
+    parser.add_argument(
+        "--sink",
+        action="append",
+        type=sink_spec,
+        metavar="SINK",
+        help="Where outputs go: file, dir:PATH, stdout or clipboard (repeatable; "
+             "default: file, plus clipboard for a single post)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Rebuild the post whenever it, its images or its rendered page change",
+    )
+    parser.add_argument(
+        "--serve",
+        nargs="?",
+        const=SERVE_ADDRESS,
+        metavar="ADDRESS",
+        help=f"Run a warm prep daemon with a local HTTP/JSON API on host:port "
+             f"or a Unix socket path (default: {SERVE_ADDRESS})",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print wall/CPU time and bytes per pipeline stage and Datawrapper call",
+    )
+    parser.add_argument(
+        "--trace-json",
+        type=Path,
+        metavar="PATH",
+        help="Write a Chrome trace-event file (open in chrome://tracing or Perfetto)",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help="Batch summary path (default: substack_manifest.json)",
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
@@ -58,7 +241,7 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--no-copy",
         action="store_true",
-        help="Skip copying rich text to clipboard",
+        help="Skip copying rich text to clipboard (drops the clipboard sink)",
     )
     parser.add_argument(
         "--open",
@@ -71,18 +254,193 @@ def parse_args() -> argparse.Namespace:
         default=None,
         help="Custom output path (default: {post}_substack.md)",
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    maintenance = (
+        args.migrate_cache
+        or args.evict_older_than is not None
+        or args.evict_unused is not None
+        or args.gc_orphans is not None
+        or args.serve is not None
+    )
+    args.selecting = args.changed_since is not None or args.stale or bool(args.tag) or args.list
+    # Selectors and --export run as a batch, however many posts they cover
+    batch = args.all or len(args.posts) > 1 or args.selecting or args.export is not None
+    if not args.posts and not args.all and not args.selecting and not maintenance:
+        parser.error("give at least one post, --all or a selector")
+    if args.output and batch:
+        parser.error("--output only applies to a single post")
+    if args.watch and (batch or len(args.posts) != 1):
+        parser.error("--watch takes exactly one post")
+    if (args.profile or args.trace_json) and batch:
+        parser.error("--profile and --trace-json only apply to a single post")
+    if args.export and args.format == "md":
+        parser.error("--export bundles HTML; use --format html or both")
+    if args.optimize_images and not args.export:
+        parser.error("--optimize-images only applies to --export")
+    if args.sink is None:
+        args.sink = ["file"] if batch or args.watch else ["file", "clipboard"]
+    if args.no_copy:
+        args.sink = [spec for spec in args.sink if spec != "clipboard"]
+    single = sorted({"stdout", "clipboard"} & set(args.sink))
+    if single and (batch or args.watch):
+        parser.error(f"--sink {' and '.join(single)} only applies to a single post without --watch")
+    if not args.sink:
+        parser.error("no output sink left; give --sink")
+    if args.output and "file" not in args.sink:
+        parser.error("--output sets the file sink's path; add --sink file")
+    if args.export and not any(spec == "file" or spec.startswith("dir:") for spec in args.sink):
+        parser.error("--export needs a file or dir sink")
+    args.batch = batch
+    return args
+
+
+def discover_posts(patterns: list[str], include_all: bool) -> list[Path]:
+    """Expand paths/globs (and --all) into a sorted list of post files."""
+    found: set[Path] = set()
+    if include_all:
+        found.update(BLOG_DIR.glob("*/*.md"))
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True)
+        found.update(Path(m) for m in matches)
+        if not matches:
+            # Keep literal paths so main() can report them as missing
+            found.add(Path(pattern))
+    return sorted(p for p in found if not p.stem.endswith("_substack"))
+
+
+# ---------------------------------------------------------------------------
+# Tracing
+# ---------------------------------------------------------------------------
+
+class Tracer:
+    """Collects timed spans as Chrome trace events (chrome://tracing, Perfetto).
+
+    Each span records wall and CPU time plus whatever arguments the code
+    inside attaches (bytes in/out, match counts, HTTP status).
+    """
+
+    def __init__(self) -> None:
+        self.events: list[dict] = []
+        self.t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def span(self, name: str, cat: str, args: dict) -> Iterator[dict]:
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(args)
+        wall0, cpu0 = time.perf_counter(), time.thread_time()
+        try:
+            yield args
+        finally:
+            wall1, cpu1 = time.perf_counter(), time.thread_time()
+            stack.pop()
+            args["cpu_ms"] = round((cpu1 - cpu0) * 1000, 3)
+            event = {
+                "name": name, "cat": cat, "ph": "X",
+                "ts": round((wall0 - self.t0) * 1e6, 1),
+                "dur": round((wall1 - wall0) * 1e6, 1),
+                "pid": os.getpid(), "tid": threading.get_ident(),
+                "args": args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def note(self, args: dict) -> None:
+        """Attach arguments to the innermost open span on this thread."""
+        stack = self._local.__dict__.get("stack")
+        if stack:
+            stack[-1].update(args)
+
+    def write(self, path: Path) -> None:
+        path.write_text(json.dumps({"traceEvents": self.events, "displayTimeUnit": "ms"}))
+
+    def self_times(self) -> list[tuple[float, float]]:
+        """(wall ms, CPU ms) of each event, less the spans nested in it on its thread."""
+        own = [[e["dur"] / 1000, e["args"].get("cpu_ms", 0)] for e in self.events]
+        threads: dict[int, list[int]] = defaultdict(list)
+        for i, e in enumerate(self.events):
+            threads[e["tid"]].append(i)
+        for indexes in threads.values():
+            stack: list[int] = []
+            for i in sorted(indexes, key=lambda i: (self.events[i]["ts"], -self.events[i]["dur"])):
+                end = self.events[i]["ts"] + self.events[i]["dur"]
+                # Timestamps are rounded to 0.1 µs; allow for it at the edges
+                while stack and self.events[stack[-1]]["ts"] + self.events[stack[-1]]["dur"] + 1 < end:
+                    stack.pop()
+                if stack:
+                    own[stack[-1]][0] -= self.events[i]["dur"] / 1000
+                    own[stack[-1]][1] -= self.events[i]["args"].get("cpu_ms", 0)
+                stack.append(i)
+        return [(wall, cpu) for wall, cpu in own]
+
+    def print_summary(self) -> None:
+        """Print self time, CPU time and bytes per span name, slowest first.
+
+        Time spent in a span nested inside another on the same thread counts
+        only towards the inner one, so the rows don't count work twice.
+        Spans in the "total" category time the whole run and come last.
+        """
+        rows: dict[tuple[str, str], list] = {}
+        totals = []
+        for e, (wall, cpu) in zip(self.events, self.self_times()):
+            if e["cat"] == "total":
+                totals.append(e)
+                continue
+            row = rows.setdefault((e["cat"], e["name"]), [0, 0.0, 0.0, 0, 0])
+            row[0] += 1
+            row[1] += wall
+            row[2] += cpu
+            row[3] += e["args"].get("input_bytes", 0)
+            row[4] += e["args"].get("output_bytes", 0)
+        print(f"\n{'span':<44} {'n':>4} {'self ms':>9} {'cpu ms':>9} {'in':>10} {'out':>10}")
+        for (cat, name), (n, wall, cpu, inb, outb) in sorted(rows.items(), key=lambda r: -r[1][1]):
+            print(f"{cat + ':' + name:<44.44} {n:>4} {wall:>9.1f} {cpu:>9.1f} "
+                  f"{format_bytes(inb) if inb else '':>10} {format_bytes(outb) if outb else '':>10}")
+        for e in totals:
+            inb, outb = e["args"].get("input_bytes", 0), e["args"].get("output_bytes", 0)
+            print(f"{'total:' + e['name']:<44.44} {'':>4} {e['dur'] / 1000:>9.1f} {'':>9} "
+                  f"{format_bytes(inb) if inb else '':>10} {format_bytes(outb) if outb else '':>10}")
+
+
+# Set by --profile / --trace-json. While None, trace() hands out one shared
+# no-op context, so instrumented code pays a global lookup and nothing else.
+TRACER: Tracer | None = None
+# Arguments written to a disabled span land here and are never read
+NO_TRACE = contextlib.nullcontext({})
+
+
+def trace(name: str, cat: str = "stage", **args) -> contextlib.AbstractContextManager[dict]:
+    """Time the enclosed block as a span; yields a dict for extra arguments."""
+    if TRACER is None:
+        return NO_TRACE
+    return TRACER.span(name, cat, args)
+
+
+def trace_note(**args) -> None:
+    """Attach arguments to the current span, if tracing."""
+    if TRACER is not None:
+        TRACER.note(args)
+
+
+def utf8_len(text: str) -> int:
+    return len(text.encode("utf-8"))
 
 
 # ---------------------------------------------------------------------------
 # Frontmatter
 # ---------------------------------------------------------------------------
 
+FRONTMATTER = re.compile(r"^---\s*\n(.*?)\n---\s*\n", re.DOTALL)
+
+
 def strip_frontmatter(text: str) -> tuple[dict, str]:
     """Return (frontmatter dict, body without frontmatter)."""
-    match = re.match(r"^---\s*\n(.*?)\n---\s*\n", text, re.DOTALL)
+    match = FRONTMATTER.match(text)
     if not match:
         return {}, text
+    import yaml
+
     fm = yaml.safe_load(match.group(1)) or {}
     body = text[match.end():]
     return fm, body
@@ -92,7 +450,22 @@ def strip_frontmatter(text: str) -> tuple[dict, str]:
 # Footnotes
 # ---------------------------------------------------------------------------
 
+# Definitions: [^name]: text, running on over following lines until the next
+# definition, a "## " heading, or a blank line followed by an unindented line
+# (indented paragraphs after a blank line belong to the note). Matched a line
+# at a time, so the stop conditions are only tested at line breaks.
+FOOTNOTE_DEF = re.compile(
+    r"^\[\^([^\]]+)\]:\s*([^\n]*(?:\n(?!\[\^|## |\n(?!\s))[^\n]*)*)",
+    re.MULTILINE,
+)
+FOOTNOTE_REF = re.compile(r"\[\^([^\]]+)\]")
+FOOTNOTES_HEADER = re.compile(r"## Footnotes\s*\n?")
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+CONTINUATION_LINES = re.compile(r"\n\s+")
 SUPERSCRIPT_DIGITS = str.maketrans("0123456789", "⁰¹²³⁴⁵⁶⁷⁸⁹")
+# The markdown keeps notes as numbered endnotes; only the HTML carries
+# Substack's native footnote markup
+NOTES_HEADER = "\n\n---\n\n**Notes** *(Use Substack's native footnote feature: Cmd+Shift+8)*\n\n"
 
 
 def to_superscript(n: int) -> str:
@@ -100,534 +473,3644 @@ def to_superscript(n: int) -> str:
     return str(n).translate(SUPERSCRIPT_DIGITS)
 
 
-def convert_footnotes(text: str) -> str:
-    """Convert [^name] refs and definitions to numbered endnotes."""
-    # Collect definitions: [^name]: text (may span multiple lines)
-    def_pattern = re.compile(
-        r"^\[\^([^\]]+)\]:\s*(.*?)(?=\n\[\^|\n## |\n\n(?!\s)|\Z)",
-        re.MULTILINE | re.DOTALL,
+def footnote_body(raw: str) -> str:
+    """Normalize a definition body: one line per paragraph, paragraphs split by a blank line."""
+    return "\n\n".join(
+        CONTINUATION_LINES.sub(" ", para.strip()) for para in PARAGRAPH_BREAK.split(raw.strip())
     )
-    definitions: dict[str, str] = {}
-    for m in def_pattern.finditer(text):
-        name = m.group(1)
-        body = m.group(2).strip()
-        # Collapse continuation lines
-        body = re.sub(r"\n\s+", " ", body)
-        definitions[name] = body
 
-    # Remove definition blocks and any "## Footnotes" header
-    text = def_pattern.sub("", text)
-    text = re.sub(r"## Footnotes\s*\n?", "", text)
 
-    # Number the references in order of first appearance
-    ref_order: list[str] = []
+def footnote_endnote(num: int, body: str) -> str:
+    """Markdown endnote for note ``num``, marked with its superscript number."""
+    return f"{to_superscript(num)} {body}\n\n"
 
-    def ref_replacer(m: re.Match) -> str:
-        name = m.group(1)
-        if name not in ref_order:
-            ref_order.append(name)
-        num = ref_order.index(name) + 1
-        return to_superscript(num)
 
-    text = re.sub(r"\[\^([^\]]+)\]", ref_replacer, text)
+def footnote_anchor(num: int, use: int = 1) -> str:
+    """Substack's in-text footnote link; repeated refs get a ``-k`` id suffix."""
+    suffix = f"-{use}" if use > 1 else ""
+    return (
+        f'<a class="footnote-anchor" data-component-name="FootnoteAnchorToDOM" href="#footnote-{num}" '
+        f'id="footnote-anchor-{num}{suffix}" target="_self">{num}</a>'
+    )
+
 
-    # Append endnotes section
-    if ref_order:
-        notes = "\n\n---\n\n**Notes** *(Use Substack's native footnote feature: Cmd+Shift+8)*\n\n"
-        for i, name in enumerate(ref_order, 1):
-            body = definitions.get(name, "")
-            notes += f"{to_superscript(i)} {body}\n\n"
-        text = text.rstrip() + notes
+def footnote_note(num: int, content: str) -> str:
+    """Substack's markup for note ``num`` around its rendered HTML.
 
-    return text
+    Substack's editor imports each ``div.footnote`` as a real footnote on paste.
+    """
+    inner = f"\n{content}\n" if content else ""
+    return (
+        f'<div class="footnote" data-component-name="FootnoteToDOM"><a class="footnote-number" '
+        f'contenteditable="false" href="#footnote-anchor-{num}" id="footnote-{num}" target="_self">{num}</a>'
+        f'<div class="footnote-content">{inner}</div>\n</div>'
+    )
 
 
 # ---------------------------------------------------------------------------
 # Math
 # ---------------------------------------------------------------------------
 
-def convert_math(text: str) -> str:
-    """Wrap $$...$$ and $...$ in [LATEX: ...] markers."""
-    # Block math first (greedy across lines)
-    text = re.sub(
-        r"\$\$(.*?)\$\$",
-        lambda m: f"[LATEX_BLOCK: {m.group(1).strip()}]",
-        text,
-        flags=re.DOTALL,
-    )
-    # Inline math (non-greedy, single line)
-    # Require first char after $ to not be a digit or space — avoids matching $100 dollar amounts
-    text = re.sub(
-        r"(?<!\$)\$(?!\$)(?!\d)(?! )(.+?)\$(?!\$)",
-        lambda m: f"[LATEX: {m.group(1).strip()}]",
-        text,
+# Block math (non-greedy across lines)
+BLOCK_MATH = re.compile(r"\$\$(.*?)\$\$", re.DOTALL)
+# Inline math (non-greedy, single line)
+# Require first char after $ to not be a digit or space — avoids matching $100 dollar amounts
+INLINE_MATH = re.compile(r"(?<!\$)\$(?!\$)(?!\d)(?! )(.+?)\$(?!\$)")
+
+
+def latex_block(m: re.Match) -> str:
+    return f"[LATEX_BLOCK: {m.group(1).strip()}]"
+
+
+def latex_inline(m: re.Match) -> str:
+    return f"[LATEX: {m.group(1).strip()}]"
+
+
+def mathtext_image(formula: str, display: bool, fmt: str) -> bytes:
+    """Render a formula with matplotlib's mathtext (a subset of LaTeX)."""
+    from matplotlib import mathtext
+    from matplotlib.font_manager import FontProperties
+
+    buf = io.BytesIO()
+    mathtext.math_to_image(
+        f"${' '.join(formula.split())}$", buf,
+        prop=FontProperties(size=16 if display else 12), dpi=MATH_DPI, format=fmt,
     )
-    return text
+    return buf.getvalue()
+
+
+# Formula renderers by name: (formula, display, format) -> image bytes.
+# Add an entry to plug in another backend (e.g. a local LaTeX install).
+MATH_RENDERERS: dict[str, Callable[[str, bool, str], bytes]] = {
+    "mathtext": mathtext_image,
+}
+MATH_FORMATS = ("png", "svg")
+MATH_MIME_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def render_formula_file(renderer: str, formula: str, display: bool, fmt: str, path: Path) -> str | None:
+    """Render one formula to path. Returns an error message, or None on success.
+
+    Formulas the renderer rejects get a ``.failed`` file next to path so they
+    aren't retried until the formula or settings change.
+    """
+    try:
+        data = MATH_RENDERERS[renderer](formula, display, fmt)
+    except ImportError as e:
+        # Not the formula's fault: don't record it as failed
+        return f"{renderer} renderer unavailable ({e.name} not installed)"
+    except Exception as e:
+        # Parser errors echo the formula first; the last line says what's wrong
+        lines = [line.strip() for line in str(e).splitlines() if line.strip()]
+        error = lines[-1] if lines else type(e).__name__
+        path.with_suffix(".failed").write_text(error)
+        return error
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    tmp.replace(path)
+    return None
+
+
+def process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """A process pool that can be started while other threads are running.
+
+    Forking with live threads can copy a lock another thread holds into the
+    child, which then deadlocks on it; formulas are rendered from a
+    run_stages worker thread. Workers come from a forkserver instead, or
+    are spawned where that isn't available.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method))
+
+
+class MathImages:
+    """Offline formula images, cached on disk by a hash of the formula.
+
+    Files live in ``.substack_math/`` at the project root, named by the
+    sha256 of renderer, format, DPI, display mode and formula, so re-running
+    a post whose math hasn't changed renders nothing. Missing formulas are
+    rendered in parallel worker processes.
+
+    Images are embedded as ``data:`` URIs, so the output carries them
+    wherever it is pasted or bundled; formula images are a few KB each.
+    """
+
+    def __init__(self, renderer: str = "mathtext", fmt: str = "png", jobs: int | None = None) -> None:
+        self.renderer = renderer
+        self.fmt = fmt
+        self.jobs = jobs or os.cpu_count() or 1
+
+    def path_for(self, cache_dir: Path, formula: str, display: bool) -> Path:
+        key = hashlib.sha256(
+            f"{self.renderer}\0{self.fmt}\0{MATH_DPI}\0{display:d}\0{formula}".encode("utf-8")
+        ).hexdigest()
+        return cache_dir / f"{key[:16]}.{self.fmt}"
+
+    def render(self, formulas: list[tuple[str, bool]], post_path: Path) -> dict[tuple[str, bool], str]:
+        """Render formulas as needed; map each (formula, display) to a data: URI.
+
+        Formulas that fail to render are left out and keep their
+        [LATEX: ...] marker.
+        """
+        cache_dir = find_project_root(post_path).resolve() / ".substack_math"
+        paths = {f: self.path_for(cache_dir, *f) for f in dict.fromkeys(formulas) if f[0]}
+        for f, path in list(paths.items()):
+            if path.with_suffix(".failed").exists():
+                del paths[f]
+        missing = [f for f, path in paths.items() if not path.exists()]
+        if missing:
+            cache_dir.mkdir(exist_ok=True)
+        print(f"  {len(paths)} formulas, {len(paths) - len(missing)} cached, rendering {len(missing)}")
+
+        if len(missing) > 1 and self.jobs > 1:
+            with process_pool(min(self.jobs, len(missing))) as pool:
+                errors = list(pool.map(
+                    render_formula_file,
+                    *zip(*[(self.renderer, *f, self.fmt, paths[f]) for f in missing]),
+                ))
+        else:
+            errors = [render_formula_file(self.renderer, *f, self.fmt, paths[f]) for f in missing]
+        for f, error in zip(missing, errors):
+            if error:
+                print(f"  ⚠ Could not render {f[0]!r}: {error}")
+                del paths[f]
+        mime = MATH_MIME_TYPES[self.fmt]
+        return {
+            f: f"data:{mime};base64,{base64.b64encode(path.read_bytes()).decode('ascii')}"
+            for f, path in paths.items()
+        }
+
+
+def formula_image(formula: str, uri: str) -> str:
+    """Markdown image for a rendered formula, with the LaTeX as alt text."""
+    alt = re.sub(r"([\[\]\\])", r"\\\1", " ".join(formula.split()))
+    return f"![{alt}]({uri})"
 
 
 # ---------------------------------------------------------------------------
 # Image shortcodes
 # ---------------------------------------------------------------------------
 
-def resolve_image_urls(post_path: Path) -> dict[str, str]:
-    """Build the site and extract hashed image URLs from the rendered HTML."""
-    post_dir = post_path.parent.name
+# Match {% image "src", "alt" %} with optional extra args (widths, sizes)
+IMAGE_SHORTCODE = re.compile(
+    r"\{%\s*image\s+\"([^\"]+)\"\s*,\s*\"([^\"]*)\"\s*(?:,\s*([^%]*))?\s*%\}"
+)
+# The first extra arg: an array literal or a single value
+IMAGE_WIDTHS_ARG = re.compile(r"\s*(\[[^\]]*\]|[^,]*)")
+# Template literals eleventy-img treats as "the original width"
+IMAGE_AUTO_WIDTHS = {"", "auto", "null", "undefined", "false", "0"}
+
+
+def image_widths(m: re.Match) -> list[int | None] | None:
+    """The widths argument of a matched image shortcode.
+
+    None in the list stands for the original width, which is also what no
+    argument, "auto" or null mean. Returns None altogether when the
+    argument isn't a literal (e.g. a template variable), since its output
+    names can't be predicted then.
+    """
+    if not m.group(3):
+        return [None]
+    arg = IMAGE_WIDTHS_ARG.match(m.group(3)).group(1).strip()
+    items = arg[1:-1].split(",") if arg.startswith("[") else [arg]
+    widths: list[int | None] = []
+    for item in items:
+        item = item.strip().strip("\"'")
+        if item in IMAGE_AUTO_WIDTHS:
+            widths.append(None)
+        elif item.isdigit():
+            widths.append(int(item))
+        else:
+            return None
+    return widths
+
+
+def find_project_root(post_path: Path) -> Path:
+    """Walk up to find the project root (where eleventy.config.js lives)."""
     project_root = post_path
-    # Walk up to find the project root (where eleventy.config.js lives)
     while project_root.parent != project_root:
         if (project_root / "eleventy.config.js").exists():
             break
         project_root = project_root.parent
+    return project_root
 
-    rendered_html = project_root / "_site" / "blog" / post_dir / "index.html"
-    if not rendered_html.exists():
-        return {}
 
-    html = rendered_html.read_text()
-    soup = BeautifulSoup(html, "html.parser")
-    mapping: dict[str, str] = {}
-    for img in soup.find_all("img"):
-        alt = img.get("alt", "")
-        src = img.get("src", "")
-        if alt and src:
-            mapping[alt] = f"{SITE_URL}{src}"
-    return mapping
+def srcset_urls(srcset: str) -> list[str]:
+    """URLs from a srcset attribute, in order."""
+    return [c.split()[0] for c in srcset.split(",") if c.strip()]
 
 
-def convert_images(text: str, post_path: Path) -> str:
-    """Convert {% image %} shortcodes to standard markdown images."""
-    # Resolve actual hashed URLs from the built site
-    url_map = resolve_image_urls(post_path)
+def parse_rendered_images(page: Path) -> list[dict]:
+    """Stream a rendered page and return its images in document order.
 
-    def image_replacer(m: re.Match) -> str:
-        src = m.group(1).strip().strip("\"'")
-        alt = m.group(2).strip().strip("\"'")
-        if alt in url_map:
-            img_url = url_map[alt]
-        else:
-            # Fallback: flag for manual resolution
-            img_url = f"[IMAGE URL NOT FOUND — upload {Path(src).name} manually]"
-            print(f"  ⚠ Could not resolve image URL for \"{alt}\" ({src})")
-        return f"![{alt}]({img_url})"
+    Each entry has the ``alt`` text, the fallback ``src`` URL, whether the
+    image came from the eleventy-img shortcode, and ``variants``: the
+    avif/webp/fallback URLs listed by the surrounding ``<picture>``.
+    """
+    from lxml import etree
 
-    # Match {% image "src", "alt" %} with optional extra args
-    text = re.sub(
-        r"\{%\s*image\s+\"([^\"]+)\"\s*,\s*\"([^\"]*)\"\s*(?:,\s*[^%]*)?\s*%\}",
-        image_replacer,
-        text,
-    )
-    return text
+    images: list[dict] = []
+    sources: list[tuple[str, str]] = []
+    for event, el in etree.iterparse(
+        str(page), events=("start", "end"), html=True, tag=("picture", "source", "img"),
+    ):
+        if el.tag == "picture":
+            sources = []
+        elif event == "start" and el.tag == "source":
+            fmt = el.get("type", "").removeprefix("image/")
+            sources.append((fmt, el.get("srcset", "")))
+        elif event == "start" and el.tag == "img":
+            src = el.get("src", "")
+            variants: dict[str, list[str]] = defaultdict(list)
+            for fmt, srcset in sources:
+                variants[fmt].extend(srcset_urls(srcset))
+            fallback_fmt = Path(src).suffix.lstrip(".") or "auto"
+            variants[fallback_fmt].extend(srcset_urls(el.get("srcset", "")) or [src])
+            images.append({
+                "alt": el.get("alt", ""),
+                "src": src,
+                "shortcode": "responsive-image" in el.get("class", "").split(),
+                "variants": dict(variants),
+            })
+            sources = []
+        if event == "end":
+            el.clear()
+    return images
 
 
-# ---------------------------------------------------------------------------
-# Nunjucks stripping
-# ---------------------------------------------------------------------------
+def image_size(data: bytes) -> tuple[str, int, int] | None:
+    """Return (format, width, height) for PNG, GIF and JPEG bytes."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        width, height = struct.unpack(">II", data[16:24])
+        return "png", width, height
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        width, height = struct.unpack("<HH", data[6:10])
+        return "gif", width, height
+    if data[:2] == b"\xff\xd8":
+        pos = 2
+        while pos + 9 < len(data):
+            if data[pos] != 0xFF:
+                pos += 1
+                continue
+            marker = data[pos + 1]
+            length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+            # Start-of-frame markers carry the dimensions
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+                return "jpeg", width, height
+            pos += 2 + length
+    return None
 
-def strip_nunjucks(text: str) -> str:
-    """Remove remaining Nunjucks tags like {% ... %} and {{ ... }}."""
-    text = re.sub(r"\{%.*?%\}", "", text)
-    text = re.sub(r"\{\{.*?\}\}", "", text)
-    return text
 
+def eleventy_img_id(data: bytes) -> str:
+    """The hash @11ty/eleventy-img (v3) puts in output filenames.
 
-def strip_html_artifacts(text: str) -> str:
-    """Remove <script> blocks, HTML comments, and stray closing tags."""
-    # Remove <script>...</script> blocks
-    text = re.sub(r"<script.*?>.*?</script>", "", text, flags=re.DOTALL | re.IGNORECASE)
-    # Remove HTML comments
-    text = re.sub(r"<!--.*?-->", "", text, flags=re.DOTALL)
-    # Remove stray closing tags like </div>
-    text = re.sub(r"</?(div|span|button)[^>]*>", "", text, flags=re.IGNORECASE)
-    return text
+    sha256 of the file contents followed by the JSON of its sharp options
+    (all defaults here), base64 with non-alphanumerics removed, first 10 chars.
+    """
+    digest = hashlib.sha256(data + ELEVENTY_IMG_HASH_OPTIONS.encode()).digest()
+    return re.sub(r"[^A-Za-z0-9]", "", base64.b64encode(digest).decode())[:ELEVENTY_IMG_HASH_LENGTH]
 
 
-# ---------------------------------------------------------------------------
-# Tables — detection and conversion
-# ---------------------------------------------------------------------------
+def eleventy_img_width(original: int, widths: list[int | None]) -> int:
+    """Width of the fallback ``<img src>`` eleventy-img renders for ``widths``.
+
+    It drops widths above the original (no upscaling), falling back to the
+    original if none are left, and the ``src`` is the smallest one.
+    """
+    valid = {width or original for width in widths}
+    return min([width for width in valid if width <= original] or [original])
 
-def is_interactive_html_table(table_html: str, full_text: str) -> bool:
-    """Check if an HTML table contains interactive elements."""
-    soup = BeautifulSoup(table_html, "html.parser")
-    if soup.find(["input", "select", "textarea", "button"]):
-        return True
-    return False
 
+class ImageIndex:
+    """Persistent index of rendered and predicted image URLs.
 
-def html_table_to_df(table_html: str) -> pd.DataFrame:
-    """Parse a static HTML table into a DataFrame."""
-    dfs = pd.read_html(io.StringIO(table_html))
-    if not dfs:
-        raise ValueError("No table found in HTML")
-    return dfs[0]
+    ``pages`` holds the images in every rendered ``_site`` page; pages are
+    re-parsed only when their mtime or size changes, so repeated and batch
+    runs share one parse per page. ``sources`` holds the eleventy-img output
+    names computed from source images, keyed by content hash, so no site
+    build is needed. Stored as JSON at ``.substack_images.json`` in the
+    project root; ``save`` merges into whatever other processes have saved
+    meanwhile, so batch workers each add their own pages.
+    """
 
+    def __init__(self, project_root: Path) -> None:
+        self.site_dir = project_root / "_site"
+        self.path = project_root / ".substack_images.json"
+        self.pages, self.sources = self.load()
+        self.touched: set[tuple[str, str]] = set()  # ("pages" or "sources", key)
+        self.dirty = False
 
-def markdown_table_to_df(table_text: str) -> pd.DataFrame:
-    """Parse a markdown pipe table into a DataFrame."""
-    lines = [l.strip() for l in table_text.strip().splitlines() if l.strip()]
-    if len(lines) < 2:
-        raise ValueError("Not enough lines for a markdown table")
+    def load(self) -> tuple[dict[str, dict], dict[str, dict]]:
+        """The (pages, sources) saved on disk, empty if missing or unreadable."""
+        if self.path.exists():
+            try:
+                data = json.loads(self.path.read_text())
+                return data.get("pages", {}), data.get("sources", {})
+            except (json.JSONDecodeError, AttributeError):
+                pass
+        return {}, {}
 
-    def parse_row(line: str) -> list[str]:
-        cells = [c.strip() for c in line.strip("|").split("|")]
-        return cells
+    @contextlib.contextmanager
+    def locked(self) -> Iterator[None]:
+        """Hold an exclusive lock on the index file's lock file (where supported)."""
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        with open(self.path.with_name(f"{self.path.name}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
 
-    header = parse_row(lines[0])
-    # Skip separator line (line with dashes)
-    data_lines = [l for l in lines[2:] if not re.match(r"^\|?[\s\-:|]+\|?$", l)]
-    rows = [parse_row(l) for l in data_lines]
-    return pd.DataFrame(rows, columns=header)
+    def predicted_urls(self, source: Path, widths: list[int | None] | None = None) -> dict[str, str] | None:
+        """URLs eleventy-img would generate for a source image, by format.
 
+        Mirrors eleventy.config.images.js: avif, webp and the original
+        format under /img/, at the width the page's ``<img src>`` uses for
+        the shortcode's ``widths`` (see image_widths; default: original).
+        The fallback format is listed last. Returns None for files it can't
+        size (e.g. SVG).
+        """
+        if not source.exists():
+            return None
+        data = source.read_bytes()
+        content_hash = hashlib.sha256(data).hexdigest()
+        entry = self.sources.get(content_hash)
+        if entry is None:
+            size = image_size(data)
+            if size is None:
+                return None
+            fmt, width, _ = size
+            entry = {"id": eleventy_img_id(data), "format": fmt, "width": width}
+            self.sources[content_hash] = entry
+            self.touched.add(("sources", content_hash))
+            self.dirty = True
+        width = eleventy_img_width(entry["width"], widths or [None])
+        stem = f"{ELEVENTY_IMG_URL_PATH}{entry['id']}-{width}"
+        return {fmt: f"{stem}.{fmt}" for fmt in ("avif", "webp", entry["format"])}
 
-def extract_table_title(text: str, table_start: int) -> str | None:
-    """Extract a bold title from the line(s) immediately above a table.
+    def page_images(self, page: Path) -> list[dict]:
+        """Images on a rendered page, from the index when it is still fresh."""
+        rel = page.relative_to(self.site_dir).as_posix()
+        if not page.exists():
+            if self.pages.pop(rel, None) is not None:
+                self.touched.add(("pages", rel))
+                self.dirty = True
+            return []
+        stat = page.stat()
+        entry = self.pages.get(rel)
+        if not entry or entry["mtime_ns"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+            with trace("parse_rendered_html", "images", input_bytes=stat.st_size) as span:
+                entry = {
+                    "mtime_ns": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "images": parse_rendered_images(page),
+                }
+                span["images"] = len(entry["images"])
+            self.pages[rel] = entry
+            self.touched.add(("pages", rel))
+            self.dirty = True
+        return entry["images"]
 
-    Looks for a pattern like **Some Title** on the non-empty line preceding
-    the table and returns the text without the ``**`` markers.
+    def save(self) -> None:
+        """Write the index if it changed.
+
+        Under the lock, the saved index is re-read and only the entries this
+        process changed are applied to it, then it is replaced atomically.
+        """
+        if not self.dirty:
+            return
+        with self.locked():
+            saved = dict(zip(("pages", "sources"), self.load()))
+            mine = {"pages": self.pages, "sources": self.sources}
+            for table, key in self.touched:
+                if key in mine[table]:
+                    saved[table][key] = mine[table][key]
+                else:
+                    saved[table].pop(key, None)
+            tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+            tmp.write_text(json.dumps(saved))
+            tmp.replace(self.path)
+        self.pages, self.sources = saved["pages"], saved["sources"]
+        self.touched.clear()
+        self.dirty = False
+
+
+def resolve_image_urls(
+    post_path: Path,
+    text: str | None = None,
+    index: ImageIndex | None = None,
+) -> dict[str, str]:
+    """Map image shortcodes to their hashed eleventy-img URLs.
+
+    URLs are computed from the source images, so no site build is needed.
+    When the post has been rendered, the Nth ``{% image %}`` is checked
+    against the Nth eleventy-img picture on the page and the rendered URL
+    wins if they disagree. Keys are shortcode sources, plus unique alt
+    texts from the rendered page as a fallback.
     """
-    before = text[:table_start].rstrip("\n")
-    lines = before.splitlines()
-    # Walk backwards past blank lines
-    for line in reversed(lines):
-        stripped = line.strip()
-        if not stripped:
-            continue
-        m = re.match(r"^\*\*(.+?)\*\*$", stripped)
-        if m:
-            return m.group(1)
-        break
-    return None
+    project_root = find_project_root(post_path)
+    own_index = index is None
+    index = index or ImageIndex(project_root)
+    rendered_html = project_root / "_site" / "blog" / post_path.parent.name / "index.html"
+    images = index.page_images(rendered_html)
 
+    text = post_path.read_text() if text is None else text
+    matches = list(IMAGE_SHORTCODE.finditer(text))
+    shortcodes = [m.group(1).strip().strip("\"'") for m in matches]
+    mapping: dict[str, str] = {}
+    for src, m in zip(shortcodes, matches):
+        widths = image_widths(m)
+        predicted = widths and index.predicted_urls(post_path.parent / src, widths)
+        if predicted:
+            mapping[src] = f"{SITE_URL}{list(predicted.values())[-1]}"
+    if own_index:
+        index.save()
 
-def find_markdown_tables(text: str) -> list[tuple[str, int, int]]:
-    """Find markdown pipe tables. Returns list of (table_text, start, end)."""
-    pattern = re.compile(
-        r"((?:^\|.+\|[ \t]*\n){2,}(?:^\|.+\|[ \t]*$)?)",
-        re.MULTILINE,
-    )
-    results = []
-    for m in pattern.finditer(text):
-        table = m.group(0)
-        # Verify it has a separator line
-        lines = table.strip().splitlines()
-        if len(lines) >= 2 and re.match(r"^\|[\s\-:|]+\|$", lines[1].strip()):
-            results.append((table, m.start(), m.end()))
-    return results
+    rendered = [img for img in images if img["shortcode"]]
+    if len(shortcodes) == len(rendered):
+        for src, img in zip(shortcodes, rendered):
+            url = f"{SITE_URL}{img['src']}"
+            if src in mapping and mapping[src] != url:
+                print(f"  ⚠ Computed URL for {src} differs from _site; using the rendered one")
+            mapping[src] = url
 
+    alts = [img["alt"] for img in images]
+    for img in images:
+        if img["alt"] and img["src"] and alts.count(img["alt"]) == 1:
+            mapping.setdefault(img["alt"], f"{SITE_URL}{img['src']}")
+    trace_note(shortcodes=len(shortcodes), rendered=len(rendered))
+    return mapping
 
-def find_html_tables(text: str) -> list[tuple[str, int, int]]:
-    """Find HTML <table>...</table> blocks. Returns list of (html, start, end)."""
-    results = []
-    pattern = re.compile(r"<table.*?>.*?</table>", re.DOTALL | re.IGNORECASE)
-    for m in pattern.finditer(text):
-        results.append((m.group(0), m.start(), m.end()))
-    return results
 
+def resolve_image(m: re.Match, url_map: dict[str, str]) -> tuple[str, str]:
+    """(alt, url) for one matched image shortcode."""
+    src = m.group(1).strip().strip("\"'")
+    alt = m.group(2).strip().strip("\"'")
+    img_url = url_map.get(src) or url_map.get(alt)
+    if not img_url:
+        # Fallback: flag for manual resolution
+        img_url = f"[IMAGE URL NOT FOUND — upload {Path(src).name} manually]"
+        print(f"  ⚠ Could not resolve image URL for \"{alt}\" ({src})")
+    return alt, img_url
 
-def has_nearby_script(text: str, table_end: int) -> bool:
-    """Check if there's a <script> tag associated with this table region."""
-    # Look for script tags after the table (within a reasonable distance or at end)
-    remaining = text[table_end:]
-    # If there's a script tag before the next major section, it's likely interactive
-    next_section = re.search(r"\n## ", remaining)
-    search_region = remaining[:next_section.start()] if next_section else remaining
-    return "<script>" in search_region.lower()
 
+def encode_variant(source: Path, path: Path, max_width: int, quality: int) -> str | None:
+    """Write a width-capped, recompressed copy of source. Returns an error, or None."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return "Pillow not installed"
+    try:
+        with Image.open(source) as im:
+            fmt = im.format
+            if fmt not in ("PNG", "JPEG", "WEBP"):
+                return f"{fmt} images are left as-is"
+            im.load()
+            if im.width > max_width:
+                im = im.resize((max_width, round(im.height * max_width / im.width)), Image.LANCZOS)
+            buf = io.BytesIO()
+            if fmt == "PNG":
+                # Charts rarely use more than 256 colours; a palette is lossless for them
+                if im.mode in ("RGB", "RGBA") and im.getcolors(256):
+                    im = im.quantize(256, method=Image.Quantize.FASTOCTREE if im.mode == "RGBA" else None)
+                im.save(buf, "PNG", optimize=True)
+            elif fmt == "JPEG":
+                im.convert("RGB").save(buf, "JPEG", quality=quality, optimize=True, progressive=True)
+            else:
+                im.save(buf, "WEBP", quality=quality, method=6)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_bytes(buf.getvalue())
+    tmp.replace(path)
+    return None
 
-# ---------------------------------------------------------------------------
-# Datawrapper API
-# ---------------------------------------------------------------------------
 
-class DatawrapperClient:
-    def __init__(self, token: str) -> None:
-        self.client = httpx.Client(
-            base_url=DW_API,
-            headers={"Authorization": f"Bearer {token}"},
-            timeout=30.0,
-        )
+class ImageVariants:
+    """Substack-sized variants of a post's source images, cached on disk.
 
-    def create_chart(self, title: str) -> str:
-        """Create a Datawrapper table chart, return chart ID."""
-        resp = self.client.post(
-            "/charts",
-            json={"title": title, "type": "tables"},
-        )
-        resp.raise_for_status()
-        return resp.json()["id"]
+    Variants live in ``.substack_variants/`` at the project root, named by
+    the sha256 of the source bytes and the target settings, and missing
+    ones are encoded in parallel worker processes. A variant is only used
+    when it is smaller than its source.
 
-    def upload_data(self, chart_id: str, csv_data: str) -> None:
-        """Upload CSV data to a chart."""
-        resp = self.client.put(
-            f"/charts/{chart_id}/data",
-            content=csv_data.encode("utf-8"),
-            headers={"Content-Type": "text/csv"},
-        )
-        resp.raise_for_status()
+    Only the export bundle stores variants: the markdown and clipboard HTML
+    keep the public image URLs, since local paths mean nothing to Substack.
+    """
 
-    def set_columns_as_text(self, chart_id: str, df: pd.DataFrame) -> None:
-        """Force columns containing '%' values to be treated as text."""
-        overrides: dict[str, dict] = {}
-        for col in df.columns:
-            if df[col].astype(str).str.contains("%").any():
-                overrides[col] = {"type": "text"}
-        if overrides:
-            resp = self.client.patch(
-                f"/charts/{chart_id}",
-                json={"metadata": {"data": {"column-format": overrides}}},
-            )
-            resp.raise_for_status()
+    def __init__(self, max_width: int = IMAGE_MAX_WIDTH, quality: int = IMAGE_QUALITY, jobs: int | None = None) -> None:
+        self.max_width = max_width
+        self.quality = quality
+        self.jobs = jobs or os.cpu_count() or 1
 
-    def publish(self, chart_id: str) -> str:
-        """Publish the chart and return the embed URL."""
-        resp = self.client.post(f"/charts/{chart_id}/publish")
-        resp.raise_for_status()
-        data = resp.json()
-        # The public URL follows this pattern
-        return data.get("data", {}).get("metadata", {}).get(
-            "publish", {}
-        ).get("embed-url", f"https://datawrapper.dwcdn.net/{chart_id}/1/")
+    def path_for(self, cache_dir: Path, source: Path) -> Path:
+        digest = hashlib.sha256(source.read_bytes())
+        digest.update(f"\0{self.max_width}\0{self.quality}".encode("ascii"))
+        return cache_dir / f"{digest.hexdigest()[:16]}{source.suffix.lower()}"
 
-    def close(self) -> None:
-        self.client.close()
+    def optimize(self, sources: Iterable[Path], root: Path) -> dict[Path, Path]:
+        """Encode variants as needed; map each source image to its smaller variant."""
+        cache_dir = root.resolve() / ".substack_variants"
+        paths = {}
+        for source in dict.fromkeys(sources):
+            if source.is_file():
+                paths[source] = (source, self.path_for(cache_dir, source))
+        missing = [src for src, (_, path) in paths.items() if not path.exists()]
+        if missing:
+            cache_dir.mkdir(exist_ok=True)
+        print(f"  {len(paths)} images, {len(paths) - len(missing)} cached, encoding {len(missing)}")
+
+        jobs = [(*paths[src], self.max_width, self.quality) for src in missing]
+        if len(jobs) > 1 and self.jobs > 1:
+            with process_pool(min(self.jobs, len(jobs))) as pool:
+                errors = list(pool.map(encode_variant, *zip(*jobs)))
+        else:
+            errors = [encode_variant(*job) for job in jobs]
+        for src, error in zip(missing, errors):
+            if error:
+                print(f"  ⚠ Kept original {src}: {error}")
 
+        mapping: dict[Path, Path] = {}
+        before = after = 0
+        for source, path in paths.values():
+            size = source.stat().st_size
+            variant_size = path.stat().st_size if path.exists() else size
+            before += size
+            if variant_size < size:
+                mapping[source] = path
+                after += variant_size
+            else:
+                after += size
+        print(f"  Images: {format_bytes(before)} → {format_bytes(after)} "
+              f"(saved {format_bytes(before - after)})")
+        return mapping
 
-def load_cache(post_path: Path) -> dict[str, str]:
-    """Load Datawrapper chart ID cache for a post."""
-    cache_path = post_path.with_name(post_path.stem + "_datawrapper.json")
-    if cache_path.exists():
-        return json.loads(cache_path.read_text())
-    return {}
 
+def format_bytes(n: float) -> str:
+    """Human-readable byte count."""
+    for unit in ("B", "KB", "MB"):
+        if abs(n) < 1024 or unit == "MB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
 
-def save_cache(post_path: Path, cache: dict[str, str]) -> None:
-    """Save Datawrapper chart ID cache."""
-    cache_path = post_path.with_name(post_path.stem + "_datawrapper.json")
-    cache_path.write_text(json.dumps(cache, indent=2))
 
+# ---------------------------------------------------------------------------
+# Nunjucks and HTML artifacts
+# ---------------------------------------------------------------------------
 
-def df_to_cache_key(df: pd.DataFrame) -> str:
-    """Create a stable cache key from a DataFrame's content."""
-    return df.to_csv(index=False).strip()
+NUNJUCKS_TAG = re.compile(r"\{%.*?%\}")
+NUNJUCKS_EXPR = re.compile(r"\{\{.*?\}\}")
+SCRIPT_BLOCK = re.compile(r"<script.*?>.*?</script>", re.DOTALL | re.IGNORECASE)
+HTML_COMMENT = re.compile(r"<!--.*?-->", re.DOTALL)
+STRAY_TAG = re.compile(r"</?(div|span|button)[^>]*>", re.IGNORECASE)
 
 
 # ---------------------------------------------------------------------------
-# Main table replacement logic
+# Tables — detection and conversion
 # ---------------------------------------------------------------------------
 
-def process_tables(
-    text: str,
-    post_title: str,
-    post_path: Path,
-    dry_run: bool,
-) -> str:
-    """Find and replace all tables with Datawrapper embeds."""
-    dw_client: DatawrapperClient | None = None
-    cache: dict[str, str] = {}
+# Cells pandas.read_html treated as missing; they are written as empty strings
+MISSING_CELLS = {
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+    "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+}
+NUMBER = re.compile(r"^[-+]?(\d{1,3}(,\d{3})+|\d*)(\.\d+)?([eE][-+]?\d+)?$")
+WHITESPACE_RUNS = re.compile(r"[\r\n]+|\s{2,}")
+INTERACTIVE_TAGS = {"input", "select", "textarea", "button"}
 
-    if not dry_run:
-        load_dotenv()
-        token = os.getenv("DATAWRAPPER_TOKEN")
-        if not token:
-            print("ERROR: DATAWRAPPER_TOKEN not found in .env", file=sys.stderr)
-            print("Tables will be left as-is. Set the token and re-run.", file=sys.stderr)
-            return text
-        dw_client = DatawrapperClient(token)
-        cache = load_cache(post_path)
 
-    table_num = 0
-    replacements: list[tuple[int, int, str]] = []
+LINE_BREAKS = "\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+BOLD_CELL = re.compile(r"\*\*(.+?)\*\*")
+PREVIEW_ROWS = 4
+# Tables are parsed and uploaded this many characters/bytes at a time
+CHUNK_SIZE = 1 << 16
 
-    # --- HTML tables ---
-    for table_html, start, end in find_html_tables(text):
-        table_num += 1
-        if is_interactive_html_table(table_html, text) or has_nearby_script(text, end):
-            print(f"  ⚠ Table {table_num}: Interactive HTML table — skipping")
-            replacements.append((start, end, f"<!-- INTERACTIVE TABLE {table_num} — manually handle for Substack -->"))
-            continue
 
-        try:
-            df = html_table_to_df(table_html)
-        except Exception as e:
-            print(f"  ⚠ Table {table_num}: Failed to parse HTML table — {e}")
-            continue
+class TableTooLarge(ValueError):
+    """A table with more rows than DW_MAX_ROWS."""
 
-        # Strip bold markers from column headers
-        df.columns = [re.sub(r"\*\*(.+?)\*\*", r"\1", c) for c in df.columns]
 
-        csv_data = df.to_csv(index=False)
-        cache_key = csv_data.strip()
-        extracted_title = extract_table_title(text, start)
-        chart_title = extracted_title or post_title
+class CsvDigest:
+    """Stable hash of a chart's normalized table, title and column formats.
 
-        if dry_run:
-            print(f"  Table {table_num} (HTML, {len(df)} rows): would upload to Datawrapper as \"{chart_title}\"")
-            preview = df.to_string(index=False, max_rows=4)
-            print(f"    Preview:\n    {preview.replace(chr(10), chr(10) + '    ')}")
-            replacements.append((start, end, f"[DATAWRAPPER EMBED: \"{chart_title}\"]"))
-        else:
-            if cache_key in cache:
-                chart_id = cache[cache_key]
-                print(f"  Table {table_num}: Using cached chart {chart_id}")
-            else:
-                chart_id = dw_client.create_chart(chart_title)
-                dw_client.upload_data(chart_id, csv_data)
-                dw_client.set_columns_as_text(chart_id, df)
-                embed_url = dw_client.publish(chart_id)
-                cache[cache_key] = chart_id
-                print(f"  Table {table_num}: Created chart {chart_id}")
-
-            embed_url = f"https://datawrapper.dwcdn.net/{cache[cache_key]}/1/"
-            replacements.append((start, end, f"\n{embed_url}\n"))
-
-    # --- Markdown tables ---
-    for table_text, start, end in find_markdown_tables(text):
-        table_num += 1
-        try:
-            df = markdown_table_to_df(table_text)
-        except Exception as e:
-            print(f"  ⚠ Table {table_num}: Failed to parse markdown table — {e}")
-            continue
+    The hash of ``json.dumps([table, title, column_format])``, where
+    ``table`` is the CSV with whitespace stripped from both ends and from
+    the end of every line. The CSV is fed in chunks and normalized as it
+    goes, so only the current line is held.
+    """
 
-        # Strip bold markers from column headers
-        df.columns = [re.sub(r"\*\*(.+?)\*\*", r"\1", c) for c in df.columns]
+    def __init__(self) -> None:
+        self.sha = hashlib.sha256(b'["')
+        self.carry = ""
+        self.started = False
+        self.blank_lines = 0
 
-        csv_data = df.to_csv(index=False)
-        cache_key = csv_data.strip()
-        extracted_title = extract_table_title(text, start)
-        chart_title = extracted_title or post_title
+    def update(self, text: str) -> None:
+        lines = (self.carry + text).splitlines(keepends=True)
+        # A line without its break (or a lone \r) may continue in the next chunk
+        last = lines[-1] if lines else ""
+        self.carry = lines.pop() if last and (last[-1] not in LINE_BREAKS or last[-1] == "\r") else ""
+        for line in lines:
+            self._line(line.rstrip())
 
-        if dry_run:
-            print(f"  Table {table_num} (Markdown, {len(df)} rows): would upload to Datawrapper as \"{chart_title}\"")
-            preview = df.to_string(index=False, max_rows=4)
-            print(f"    Preview:\n    {preview.replace(chr(10), chr(10) + '    ')}")
-            replacements.append((start, end, f"[DATAWRAPPER EMBED: \"{chart_title}\"]"))
+    def _line(self, line: str) -> None:
+        if not line:
+            self.blank_lines += self.started
+            return
+        if not self.started:
+            self.started = True
+            text = line.lstrip()
         else:
-            if cache_key in cache:
-                chart_id = cache[cache_key]
-                print(f"  Table {table_num}: Using cached chart {chart_id}")
-            else:
-                chart_id = dw_client.create_chart(chart_title)
-                dw_client.upload_data(chart_id, csv_data)
-                dw_client.set_columns_as_text(chart_id, df)
-                embed_url = dw_client.publish(chart_id)
-                cache[cache_key] = chart_id
-                print(f"  Table {table_num}: Created chart {chart_id}")
+            text = "\n" * (self.blank_lines + 1) + line
+        self.blank_lines = 0
+        self.sha.update(json.dumps(text, ensure_ascii=False)[1:-1].encode("utf-8"))
 
-            embed_url = f"https://datawrapper.dwcdn.net/{cache[cache_key]}/1/"
-            replacements.append((start, end, f"\n{embed_url}\n"))
+    def key(self, title: str, column_format: dict[str, dict]) -> str:
+        """The cache key for this CSV under ``title``. Call once all text is in."""
+        if self.carry:
+            self._line(self.carry.rstrip())
+            self.carry = ""
+        sha = self.sha.copy()
+        rest = [title, column_format]
+        sha.update(('", ' + json.dumps(rest, sort_keys=True, ensure_ascii=False)[1:]).encode("utf-8"))
+        return sha.hexdigest()
 
-    # Apply replacements in reverse order to preserve positions
-    replacements.sort(key=lambda r: r[0], reverse=True)
-    for start, end, replacement in replacements:
-        text = text[:start] + replacement + text[end:]
 
-    if not dry_run and dw_client:
-        save_cache(post_path, cache)
-        dw_client.close()
+class SpooledBody:
+    """Re-iterable request body over a spooled file, so retries can resend it."""
 
-    return text
+    def __init__(self, file: tempfile.SpooledTemporaryFile) -> None:
+        self.file = file
 
+    def __iter__(self) -> Iterator[bytes]:
+        self.file.seek(0)
+        while chunk := self.file.read(CHUNK_SIZE):
+            yield chunk
 
-# ---------------------------------------------------------------------------
-# Pipeline
-# ---------------------------------------------------------------------------
 
-def transform(text: str, post_path: Path, dry_run: bool) -> str:
-    """Run all transformations on the post content."""
-    fm, body = strip_frontmatter(text)
-    title = fm.get("title", post_path.stem)
+class Table:
+    """A parsed table, streamed to a spooled CSV as its rows arrive.
 
-    print(f"Post: {title}")
-    print(f"Processing tables...")
-    body = process_tables(body, title, post_path, dry_run)
+    Only the header, per-column type flags, the rows ``preview`` shows and
+    the CSV digest stay in memory, so memory doesn't grow with the table.
+    Call ``finish`` with the header once every row is in.
+    """
 
-    print("Converting images...")
-    body = convert_images(body, post_path)
+    def __init__(self, interactive: bool = False, max_rows: int = DW_MAX_ROWS) -> None:
+        self.header: list[str] = []
+        self.interactive = interactive
+        self.max_rows = max_rows
+        self.count = 0
+        self.percent: list[bool] = []
+        self.numeric: list[bool] = []
+        self.head: list[list[str]] = []
+        self.tail: deque[list[str]] = deque(maxlen=PREVIEW_ROWS // 2)
+        self.rows = tempfile.SpooledTemporaryFile(SPOOL_MAX_BYTES, "w+", newline="", encoding="utf-8")
+        self.rows_writer = csv.writer(self.rows, lineterminator="\n")
+        self.data = tempfile.SpooledTemporaryFile(SPOOL_MAX_BYTES, "w+b")
+        self.size = 0
+        self.digest = CsvDigest()
 
-    print("Converting math...")
-    body = convert_math(body)
+    def __len__(self) -> int:
+        return self.count
 
-    print("Converting footnotes...")
-    body = convert_footnotes(body)
+    def add_row(self, row: list[str]) -> None:
+        """Take one data row; short rows are padded to the header in ``finish``."""
+        self.account(row)
+        if len(self.head) < PREVIEW_ROWS:
+            self.head.append(row)
+        self.tail.append(row)
+        self.rows_writer.writerow(row)
 
-    print("Stripping Nunjucks and HTML artifacts...")
-    body = strip_nunjucks(body)
-    body = strip_html_artifacts(body)
+    def account(self, row: list[str]) -> None:
+        """Count a row against the limit and update the column type flags."""
+        if self.count >= self.max_rows:
+            raise TableTooLarge(f"has more than {self.max_rows:,} rows (DATAWRAPPER_MAX_ROWS)")
+        self.count += 1
+        if len(row) > len(self.percent):
+            grow = len(row) - len(self.percent)
+            self.percent += [False] * grow
+            self.numeric += [True] * grow
+        for i, cell in enumerate(row):
+            if "%" in cell:
+                self.percent[i] = True
+            if cell and not NUMBER.match(cell):
+                self.numeric[i] = False
 
-    # Clean up excessive blank lines
-    body = re.sub(r"\n{4,}", "\n\n\n", body)
+    def write(self, text: str) -> None:
+        # Final CSV sink for csv.writer: digest, encode and spool each row
+        self.digest.update(text)
+        data = text.encode("utf-8")
+        self.data.write(data)
+        self.size += len(data)
 
-    return body.strip() + "\n"
+    def finish(self, header: list[str], first_rows: Sequence[list[str]] = ()) -> Table:
+        """Write the final CSV: the header (bold markers stripped), then every row padded.
 
+        ``first_rows`` are data rows that belong before the streamed ones but
+        were only known to be data at the end.
+        """
+        if first_rows:
+            first = list(first_rows)
+            all_in_head = self.count <= PREVIEW_ROWS
+            for row in first:
+                self.account(row)
+            if all_in_head:
+                self.tail = deque((first + self.head)[-(PREVIEW_ROWS // 2):], maxlen=PREVIEW_ROWS // 2)
+            self.head = (first + self.head)[:PREVIEW_ROWS]
+        self.header = [BOLD_CELL.sub(r"\1", c) for c in header]
+        writer = csv.writer(self, lineterminator="\n")
+        writer.writerow(self.header)
+        for row in first_rows:
+            writer.writerow(row + [""] * (len(self.header) - len(row)))
+        self.rows.seek(0)
+        for row in csv.reader(self.rows):
+            writer.writerow(row + [""] * (len(self.header) - len(row)))
+        self.rows.close()
+        return self
 
-# ---------------------------------------------------------------------------
-# Entrypoint
-# ---------------------------------------------------------------------------
+    def to_csv(self) -> str:
+        return b"".join(self.body()).decode("utf-8")
 
-def markdown_to_html(text: str) -> str:
-    """Convert the prepared markdown to an HTML page for rich-text copy-paste."""
-    body_html = md_lib.markdown(text, extensions=["extra"])
-    return f"""<!DOCTYPE html>
-<html>
-<head>
-<meta charset="utf-8">
-<style>
-  body {{ font-family: -apple-system, Georgia, serif; max-width: 680px; margin: 2em auto; padding: 0 1em; line-height: 1.6; color: #1a1a1a; }}
-  img {{ max-width: 100%; height: auto; }}
-  a {{ color: #0366d6; }}
-  hr {{ border: none; border-top: 1px solid #ddd; margin: 2em 0; }}
-  p {{ margin: 1em 0; }}
-</style>
-</head>
-<body>
-{body_html}
-</body>
-</html>"""
+    def body(self) -> SpooledBody:
+        """The CSV as a request body that streams from the spool."""
+        return SpooledBody(self.data)
 
+    def cache_key(self, title: str, column_format: dict[str, dict]) -> str:
+        return self.digest.key(title, column_format)
 
-def main() -> None:
-    args = parse_args()
+    def column_types(self) -> list[str]:
+        """Infer 'percent', 'numeric' or 'text' for each column."""
+        width = len(self.header)
+        percent = (self.percent + [False] * width)[:width]
+        numeric = (self.numeric + [True] * width)[:width]
+        return [
+            "percent" if p else "numeric" if n and self.count else "text"
+            for p, n in zip(percent, numeric)
+        ]
 
-    if not args.post.exists():
-        print(f"Error: {args.post} not found.", file=sys.stderr)
-        sys.exit(1)
+    def preview(self) -> str:
+        """Aligned text preview, eliding middle rows beyond PREVIEW_ROWS."""
+        rows = self.head
+        if self.count > PREVIEW_ROWS:
+            rows = self.head[:PREVIEW_ROWS // 2] + [["..."] * len(self.header)] + list(self.tail)
+        width = len(self.header)
+        grid = [self.header, *(row + [""] * (width - len(row)) for row in rows)]
+        widths = [max(len(r[i]) for r in grid) for i in range(width)]
+        return "\n".join(" ".join(c.rjust(w) for c, w in zip(r, widths)) for r in grid)
 
-    text = args.post.read_text()
-    result = transform(text, args.post, args.dry_run)
+    def close(self) -> None:
+        self.rows.close()
+        self.data.close()
 
-    # Determine output paths
-    if args.output:
-        out_path = args.output
-    else:
-        out_path = args.post.with_name(args.post.stem + "_substack.md")
-    html_path = out_path.with_suffix(".html")
 
-    # Write markdown
-    out_path.write_text(result)
-    print(f"\nMarkdown written to: {out_path}")
+class HTMLTableParser:
+    """Stream the rows of the first <table>, like pandas.read_html.
 
-    # Write HTML for rich-text copy-paste
-    html_content = markdown_to_html(result)
-    html_path.write_text(html_content)
-    print(f"HTML written to: {html_path}")
+    Rows go to ``on_row`` as (in_thead, cell texts, all cells were <th>) as
+    soon as they close, so the parser can be fed the table in chunks. Cell
+    text has runs of whitespace collapsed; colspan/rowspan cells are
+    repeated into every slot they cover.
 
-    if not args.no_copy:
-        try:
-            # Copy rich HTML to macOS clipboard so Cmd+V pastes formatted text
-            hex_data = subprocess.run(
-                ["xxd", "-p", str(html_path.resolve())],
-                capture_output=True, text=True, check=True,
-            ).stdout.replace("\n", "")
-            subprocess.run(
-                ["osascript", "-e", f'set the clipboard to «data HTML{hex_data}»'],
-                check=True,
-            )
-            print("Rich text copied to clipboard — paste directly into Substack.")
+    This is a mixin for ``html.parser.HTMLParser``; ``html_table_parser``
+    combines the two on first use.
+    """
+
+    def __init__(self, on_row: Callable[[bool, list[str], bool], None]) -> None:
+        super().__init__(convert_charrefs=True)
+        self.on_row = on_row
+        self.depth = 0
+        self.done = False
+        self.interactive = False
+        self.row: list[tuple[str, bool, int, int]] | None = None
+        self.cell: list[str] | None = None
+        self.cell_attrs: tuple[bool, int, int] = (False, 1, 1)
+        self.in_thead = False
+        self.pending: dict[int, tuple[str, int]] = {}  # column -> (text, rows left)
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if self.done:
+            return
+        if tag == "table":
+            self.depth += 1
+            return
+        if self.depth != 1:
+            return
+        if tag in INTERACTIVE_TAGS:
+            self.interactive = True
+        elif tag == "thead":
+            self.in_thead = True
+        elif tag in ("tbody", "tfoot"):
+            self.in_thead = False
+        elif tag == "tr":
+            self.end_row()
+            self.row = []
+        elif tag in ("td", "th"):
+            self.end_cell()
+            if self.row is None:
+                self.row = []
+            spans = dict(attrs)
+            self.cell = []
+            self.cell_attrs = (
+                tag == "th",
+                int(spans.get("colspan") or 1),
+                int(spans.get("rowspan") or 1),
+            )
+
+    def handle_endtag(self, tag: str) -> None:
+        if self.done or self.depth == 0:
+            return
+        if tag == "table":
+            self.depth -= 1
+            if self.depth == 0:
+                self.end_row()
+                self.done = True
+        elif self.depth != 1:
+            return
+        elif tag in ("td", "th"):
+            self.end_cell()
+        elif tag == "tr":
+            self.end_row()
+        elif tag == "thead":
+            self.end_row()
+            self.in_thead = False
+
+    def handle_data(self, data: str) -> None:
+        if self.cell is not None:
+            self.cell.append(data)
+
+    def end_cell(self) -> None:
+        if self.cell is not None and self.row is not None:
+            text = WHITESPACE_RUNS.sub(" ", "".join(self.cell).strip())
+            self.row.append((text, *self.cell_attrs))
+        self.cell = None
+
+    def end_row(self) -> None:
+        self.end_cell()
+        if self.row:
+            self.on_row(self.in_thead, self.expand(self.row), all(c[1] for c in self.row))
+        self.row = None
+
+    def expand(self, cells: list[tuple[str, bool, int, int]]) -> list[str]:
+        """Cell texts of one row, with spans from earlier rows filled in."""
+        texts: list[str] = []
+        queue = deque(cells)
+        col = 0
+        while queue or col in self.pending:
+            if col in self.pending:
+                text, left = self.pending.pop(col)
+                texts.append(text)
+                if left > 1:
+                    self.pending[col] = (text, left - 1)
+                col += 1
+                continue
+            text, _, colspan, rowspan = queue.popleft()
+            for _ in range(colspan):
+                texts.append(text)
+                if rowspan > 1:
+                    self.pending[col] = (text, rowspan - 1)
+                col += 1
+        return texts
+
+
+@functools.cache
+def html_table_parser() -> type[HTMLTableParser]:
+    """HTMLTableParser mixed into HTMLParser, which is only imported here."""
+    from html.parser import HTMLParser
+
+    return type("HTMLTableParser", (HTMLTableParser, HTMLParser), {})
+
+
+def missing_as_empty(row: list[str]) -> list[str]:
+    return ["" if c in MISSING_CELLS else c for c in row]
+
+
+def parse_html_table(text: str, start: int = 0, end: int | None = None) -> Table:
+    """Parse the HTML table in text[start:end], streaming its rows into a Table.
+
+    Rows in <thead>, or leading rows made only of <th>, become the header;
+    the last such row names the columns. ``Table.interactive`` flags form
+    controls.
+    """
+    end = len(text) if end is None else end
+    table = Table()
+    header: list[str] | None = None
+    leading: list[list[str]] = []  # all-<th> rows before the first data row
+    in_body = False
+    width = 0
+
+    def on_row(in_thead: bool, texts: list[str], all_th: bool) -> None:
+        nonlocal header, in_body, width
+        width = max(width, len(texts))
+        if in_thead:
+            header = texts
+        elif not in_body and all_th:
+            leading.append(texts)
+        else:
+            # Leading <th> rows are data once a <thead> has named the columns
+            if not in_body and header is not None:
+                for row in leading:
+                    table.add_row(missing_as_empty(row))
+                leading.clear()
+            in_body = True
+            table.add_row(missing_as_empty(texts))
+
+    parser = html_table_parser()(on_row)
+    try:
+        for i in range(start, end, CHUNK_SIZE):
+            parser.feed(text[i:min(i + CHUNK_SIZE, end)])
+        parser.close()
+        if not width:
+            raise ValueError("No table found in HTML")
+    except Exception:
+        table.close()
+        raise
+    table.interactive = parser.interactive
+
+    first_rows: list[list[str]] = []
+    if header is None and leading:
+        header = leading[-1]
+    elif leading:
+        # A <thead> after the body: the leading <th> rows were data
+        first_rows = [missing_as_empty(row) for row in leading]
+    if header is not None:
+        header = header + [f"Unnamed: {i}" for i in range(len(header), width)]
+    else:
+        header = [str(i) for i in range(width)]
+    return table.finish(header, first_rows)
+
+
+TABLE_LINE = re.compile(f"[^{LINE_BREAKS}]+")
+LINE_BREAK = re.compile(f"\r\n|[{LINE_BREAKS}]")
+TABLE_SEPARATOR = re.compile(r"^\|?[\s\-:|]+\|?$")
+
+
+def parse_markdown_table(text: str, start: int = 0, end: int | None = None) -> Table:
+    """Parse the markdown pipe table in text[start:end] a line at a time."""
+    end = len(text) if end is None else end
+
+    def parse_row(line: str) -> list[str]:
+        cells = [c.strip() for c in line.strip("|").split("|")]
+        return cells
+
+    table = Table()
+    header: list[str] | None = None
+    separator_seen = False
+    try:
+        for m in TABLE_LINE.finditer(text, start, end):
+            line = m.group().strip()
+            if not line:
+                continue
+            if header is None:
+                header = parse_row(line)
+            elif not separator_seen:
+                # Skip separator line (line with dashes)
+                separator_seen = True
+            elif not TABLE_SEPARATOR.match(line):
+                row = parse_row(line)
+                if len(row) > len(header):
+                    raise ValueError(f"{len(header)} columns passed, passed data had {len(row)} columns")
+                table.add_row(row)
+        if not separator_seen:
+            raise ValueError("Not enough lines for a markdown table")
+    except Exception:
+        table.close()
+        raise
+    return table.finish(header)
+
+
+BOLD_LINE = re.compile(r"^\*\*(.+?)\*\*$")
+# A markdown table is a run of two or more pipe rows, plus an unterminated
+# last row at the end of the text. Rows are matched one at a time, since a
+# repeated group over the whole run holds memory for every row.
+MARKDOWN_TABLE_ROW = re.compile(r"^\|.+\|[ \t]*\n", re.MULTILINE)
+MARKDOWN_TABLE_TAIL = re.compile(r"\|.+\|[ \t]*")
+SEPARATOR_ROW = re.compile(r"^\|[\s\-:|]+\|$")
+HTML_TABLE = re.compile(r"<table.*?>.*?</table>", re.DOTALL | re.IGNORECASE)
+SECTION_BREAK = re.compile(r"\n## ")
+SCRIPT_OPEN = re.compile(r"<script>", re.IGNORECASE)
+
+
+def extract_table_title(text: str, table_start: int) -> str | None:
+    """Extract a bold title from the line(s) immediately above a table.
+
+    Looks for a pattern like **Some Title** on the non-empty line preceding
+    the table and returns the text without the ``**`` markers.
+    """
+    # Walk backwards line by line past blank lines, without copying the prefix
+    line_end = table_start
+    while line_end > 0:
+        line_start = text.rfind("\n", 0, line_end) + 1
+        stripped = text[line_start:line_end].strip()
+        if stripped:
+            m = BOLD_LINE.match(stripped)
+            return m.group(1) if m else None
+        line_end = line_start - 1
+    return None
+
+
+def find_markdown_tables(text: str) -> list[tuple[int, int]]:
+    """Find markdown pipe tables. Returns (start, end) spans, without copying them."""
+    runs: list[list[int]] = []  # [start, end, rows]
+    for m in MARKDOWN_TABLE_ROW.finditer(text):
+        if runs and runs[-1][1] == m.start():
+            runs[-1][1:] = m.end(), runs[-1][2] + 1
+        else:
+            runs.append([m.start(), m.end(), 1])
+    if runs and (tail := MARKDOWN_TABLE_TAIL.fullmatch(text, runs[-1][1])):
+        runs[-1][1] = tail.end()
+
+    results = []
+    for start, end, rows in runs:
+        if rows < 2:
+            continue
+        # Verify its second line is a separator line
+        first = LINE_BREAK.search(text, start, end)
+        after = LINE_BREAK.search(text, first.end(), end)
+        if SEPARATOR_ROW.match(text[first.end():after.start() if after else end].strip()):
+            results.append((start, end))
+    return results
+
+
+def find_html_tables(text: str) -> list[tuple[int, int]]:
+    """Find HTML <table>...</table> blocks. Returns (start, end) spans."""
+    return [m.span() for m in HTML_TABLE.finditer(text)]
+
+
+def span_digest(text: str, start: int, end: int) -> str:
+    """sha256 of text[start:end], hashed a chunk at a time."""
+    sha = hashlib.sha256()
+    for i in range(start, end, CHUNK_SIZE):
+        sha.update(text[i:min(i + CHUNK_SIZE, end)].encode("utf-8"))
+    return sha.hexdigest()
+
+
+class DocumentIndex:
+    """Section breaks, script tags and table spans of a post body, found once.
+
+    Lets per-table checks run in O(log n) instead of rescanning the rest of
+    the document for every table.
+    """
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.sections = [m.start() for m in SECTION_BREAK.finditer(text)]
+        self.scripts = [m.start() for m in SCRIPT_OPEN.finditer(text)]
+        self.html_tables = find_html_tables(text)
+        self.markdown_tables = find_markdown_tables(text)
+
+    def has_nearby_script(self, table_end: int) -> bool:
+        """Check if there's a <script> tag associated with this table region.
+
+        If there's a script tag before the next major section, it's likely
+        interactive.
+        """
+        i = bisect.bisect_left(self.sections, table_end)
+        region_end = self.sections[i] if i < len(self.sections) else len(self.text)
+        j = bisect.bisect_left(self.scripts, table_end)
+        return j < len(self.scripts) and self.scripts[j] + len("<script>") <= region_end
+
+
+# ---------------------------------------------------------------------------
+# Datawrapper API
+# ---------------------------------------------------------------------------
+
+def text_column_overrides(table: Table) -> dict[str, dict]:
+    """Datawrapper column-format overrides: columns with '%' become text."""
+    return {
+        name: {"type": "text"}
+        for name, kind in zip(table.header, table.column_types())
+        if kind == "percent"
+    }
+
+
+def retry_delay(resp: httpx.Response | None, attempt: int) -> float:
+    """Seconds to wait before retrying: Retry-After if given, else backoff.
+
+    Either way the wait is capped at DW_MAX_BACKOFF.
+    """
+    header = resp.headers.get("Retry-After") if resp is not None else None
+    if header:
+        if header.strip().isdigit():
+            return min(DW_MAX_BACKOFF, float(header))
+        from email.utils import parsedate_to_datetime
+
+        try:
+            when = parsedate_to_datetime(header)
+            return min(DW_MAX_BACKOFF, max(0.0, when.timestamp() - time.time()))
+        except (TypeError, ValueError):
+            pass
+    return min(DW_MAX_BACKOFF, 0.5 * 2 ** attempt)
+
+
+class DatawrapperClient:
+    """Thread-safe Datawrapper API client with pooled keep-alive connections.
+
+    Requests are retried on 429/5xx and transport errors, honouring
+    Retry-After. Creating a chart is not idempotent, so ``POST /charts`` is
+    only retried when it cannot have been acted on: after a 429 or a failure
+    to connect. Per-endpoint latencies are kept for ``print_stats``.
+    """
+
+    def __init__(self, token: str, max_connections: int = DW_CONCURRENCY, max_retries: int = 4) -> None:
+        import httpx
+
+        self.client = httpx.Client(
+            base_url=DW_API,
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=30.0,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+        self.max_retries = max_retries
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request, backing off on rate limits and server errors."""
+        import httpx
+
+        endpoint = f"{method} {re.sub(r'/charts/[^/]+', '/charts/{id}', url)}"
+        creates = method == "POST" and url == "/charts"
+        not_sent = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+        for attempt in range(self.max_retries + 1):
+            t0 = time.perf_counter()
+            with trace(endpoint, "datawrapper", attempt=attempt) as span:
+                try:
+                    resp = self.client.request(method, url, **kwargs)
+                except httpx.TransportError as e:
+                    span["error"] = type(e).__name__
+                    if attempt == self.max_retries or (creates and not isinstance(e, not_sent)):
+                        raise
+                    resp = None
+                if resp is not None and TRACER is not None:
+                    span.update(
+                        status=resp.status_code,
+                        input_bytes=int(resp.request.headers.get("Content-Length", 0)),
+                        output_bytes=len(resp.content),
+                    )
+            with self._lock:
+                self.latencies[endpoint].append(time.perf_counter() - t0)
+            if resp is not None and resp.status_code != 429 and (resp.status_code < 500 or creates):
+                break
+            if attempt == self.max_retries:
+                break
+            with self._lock:
+                self.retries += 1
+            time.sleep(retry_delay(resp, attempt))
+        resp.raise_for_status()
+        return resp
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Request count, p50 and max latency (ms) per endpoint."""
+        with self._lock:
+            latencies = {endpoint: sorted(times) for endpoint, times in self.latencies.items()}
+        return {
+            endpoint: {
+                "n": len(times),
+                "p50_ms": round(times[len(times) // 2] * 1000, 1),
+                "max_ms": round(times[-1] * 1000, 1),
+            }
+            for endpoint, times in sorted(latencies.items())
+        }
+
+    def print_stats(self) -> None:
+        """Print request counts and latencies per endpoint."""
+        if not self.latencies:
+            return
+        print(f"  Datawrapper requests ({self.retries} retries):")
+        for endpoint, s in self.stats().items():
+            print(f"    {endpoint:<28} n={s['n']:<3} p50={s['p50_ms']:.0f}ms max={s['max_ms']:.0f}ms")
+
+    def create_chart(self, title: str) -> str:
+        """Create a Datawrapper table chart, return chart ID."""
+        resp = self.request(
+            "POST", "/charts",
+            json={"title": title, "type": "tables"},
+        )
+        return resp.json()["id"]
+
+    def upload_data(self, chart_id: str, table: Table) -> None:
+        """Upload a table's CSV to a chart, streamed from its spool."""
+        self.request(
+            "PUT", f"/charts/{chart_id}/data",
+            content=table.body(),
+            headers={"Content-Type": "text/csv", "Content-Length": str(table.size)},
+        )
+
+    def set_columns_as_text(
+        self, chart_id: str, table: Table, previous: dict[str, dict] | None = None,
+    ) -> None:
+        """Force columns containing '%' values to be treated as text.
+
+        ``previous`` is the column format an existing chart was published
+        with. Datawrapper merges metadata patches, so its overrides that no
+        longer apply are reset to automatic typing explicitly.
+        """
+        overrides = text_column_overrides(table)
+        column_format = {name: {"type": "auto"} for name in previous or {} if name not in overrides}
+        column_format.update(overrides)
+        if column_format:
+            self.request(
+                "PATCH", f"/charts/{chart_id}",
+                json={"metadata": {"data": {"column-format": column_format}}},
+            )
+
+    def publish(self, chart_id: str) -> str:
+        """Publish the chart and return the URL of the published version."""
+        resp = self.request("POST", f"/charts/{chart_id}/publish")
+        data = resp.json()
+        chart = data.get("data", {})
+        version = data.get("version") or chart.get("publicVersion") or 1
+        return data.get("url") or chart.get("publicUrl") or embed_url_for(chart_id, version)
+
+    def list_charts(self) -> Iterator[dict]:
+        """Yield every chart on the account, following pagination."""
+        offset = 0
+        while True:
+            resp = self.request("GET", "/charts", params={"limit": 100, "offset": offset})
+            charts = resp.json().get("list", [])
+            yield from charts
+            if len(charts) < 100:
+                return
+            offset += len(charts)
+
+    def delete_chart(self, chart_id: str) -> None:
+        self.request("DELETE", f"/charts/{chart_id}")
+
+    def close(self) -> None:
+        self.client.close()
+
+
+def legacy_cache_path(post_path: Path) -> Path:
+    """Per-post JSON chart cache used before the shared SQLite store."""
+    return post_path.with_name(post_path.stem + "_datawrapper.json")
+
+
+def table_identity(post_path: Path, position: int, title: str) -> str:
+    """Stable name for a table that survives edits to its data.
+
+    Built from the post, the table's position among the post's charts and
+    its title, so fixing a typo in a cell keeps the same identity.
+    """
+    path = post_path.resolve()
+    post = path.relative_to(PROJECT_ROOT) if path.is_relative_to(PROJECT_ROOT) else path
+    return f"{post.as_posix()}#{position}:{title}"
+
+
+def embed_url_for(chart_id: str, version: int = 1) -> str:
+    return f"https://datawrapper.dwcdn.net/{chart_id}/{version}/"
+
+
+# Steps of publishing one chart, in order. The journal records the last one done.
+PUBLISH_STEPS = ("created", "data", "columns", "published")
+
+
+class ChartCache:
+    """Chart IDs shared by every post, stored in one SQLite database.
+
+    Keys come from ``CsvDigest``, so an identical table in two posts
+    reuses one chart. Each write is its own transaction, and the connection
+    may be shared by the upload threads.
+
+    Charts still being published live in a write-ahead ``journal`` table that
+    records each finished step, so an interrupted run resumes instead of
+    creating the chart again. ``put`` moves a chart from the journal into
+    ``charts`` in one transaction.
+
+    The ``tables`` table maps each ``table_identity`` to its chart, so a table
+    whose data changed can update that chart in place.
+    """
+
+    def __init__(self, path: Path | None = None) -> None:
+        self.db = sqlite3.connect(path or CHART_CACHE_DB, timeout=30.0, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS charts (
+                    key TEXT PRIMARY KEY,
+                    chart_id TEXT NOT NULL,
+                    title TEXT,
+                    post TEXT,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    embed_url TEXT
+                )"""
+            )
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS tables (
+                    identity TEXT PRIMARY KEY,
+                    chart_id TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    column_format TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )"""
+            )
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS journal (
+                    key TEXT PRIMARY KEY,
+                    chart_id TEXT NOT NULL,
+                    step TEXT NOT NULL,
+                    title TEXT,
+                    post TEXT,
+                    updated REAL NOT NULL
+                )"""
+            )
+
+    def get(self, key: str) -> tuple[str, str] | None:
+        """Return (chart_id, embed_url) for a key and mark it as used."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT chart_id, embed_url FROM charts WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                with self.db:
+                    self.db.execute("UPDATE charts SET last_used = ? WHERE key = ?", (time.time(), key))
+        if not row:
+            return None
+        return row[0], row[1] or embed_url_for(row[0])
+
+    def put(
+        self,
+        key: str,
+        chart_id: str,
+        title: str,
+        post: Path,
+        embed_url: str | None = None,
+        identity: str | None = None,
+        column_format: dict[str, dict] | None = None,
+    ) -> None:
+        """Record a published chart, replacing any older data for the same chart."""
+        now = time.time()
+        with self.lock, self.db:
+            # An updated chart no longer shows the data its old key described
+            self.db.execute("DELETE FROM charts WHERE chart_id = ? AND key != ?", (chart_id, key))
+            self.db.execute(
+                "INSERT OR REPLACE INTO charts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, chart_id, title, str(post), now, now, embed_url),
+            )
+            if identity:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO tables VALUES (?, ?, ?, ?, ?)",
+                    (identity, chart_id, key, json.dumps(column_format or {}, sort_keys=True), now),
+                )
+            self.db.execute("DELETE FROM journal WHERE key = ?", (key,))
+
+    def identity_chart(self, identity: str) -> tuple[str, dict[str, dict]] | None:
+        """Return (chart_id, column_format) last published for a table identity.
+
+        Returns None if the chart is also used by another table, since
+        updating it in place would change that table too.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT chart_id, column_format FROM tables WHERE identity = ?", (identity,)
+            ).fetchone()
+            if not row:
+                return None
+            shared = self.db.execute(
+                "SELECT 1 FROM tables WHERE chart_id = ? AND identity != ?", (row[0], identity)
+            ).fetchone()
+        return None if shared else (row[0], json.loads(row[1]))
+
+    def link(self, identity: str, key: str) -> None:
+        """Point a table identity at the cached chart for ``key``."""
+        with self.lock, self.db:
+            self.db.execute(
+                """INSERT OR REPLACE INTO tables
+                   SELECT ?, chart_id, key, COALESCE(
+                       (SELECT column_format FROM tables WHERE key = ?), '{}'), ?
+                   FROM charts WHERE key = ?""",
+                (identity, key, time.time(), key),
+            )
+
+    def journal_get(self, key: str) -> tuple[str, str] | None:
+        """Return (chart_id, last finished step) for a chart in progress."""
+        with self.lock:
+            row = self.db.execute("SELECT chart_id, step FROM journal WHERE key = ?", (key,)).fetchone()
+        return tuple(row) if row else None
+
+    def journal_step(self, key: str, chart_id: str, step: str, title: str, post: Path) -> None:
+        """Record that ``step`` finished for a chart in progress."""
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?, ?)",
+                (key, chart_id, step, title, str(post), time.time()),
+            )
+
+    def incomplete(self) -> list[tuple[str, str, str, str, str]]:
+        """Charts created but never recorded: (key, chart_id, step, title, post)."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT key, chart_id, step, title, post FROM journal ORDER BY updated"
+            ).fetchall()
+
+    def forget(self, key: str) -> None:
+        """Drop a journal entry (after its chart was deleted)."""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM journal WHERE key = ?", (key,))
+
+    def known_chart_ids(self) -> set[str]:
+        with self.lock:
+            rows = self.db.execute("SELECT chart_id FROM charts UNION SELECT chart_id FROM journal")
+            return {r[0] for r in rows}
+
+    def evict(self, older_than_days: float | None = None, unused_days: float | None = None) -> int:
+        """Drop entries created or last used too long ago. Returns rows removed."""
+        now = time.time()
+        removed = 0
+        with self.lock, self.db:
+            if older_than_days is not None:
+                removed += self.db.execute(
+                    "DELETE FROM charts WHERE created < ?", (now - older_than_days * 86400,)
+                ).rowcount
+            if unused_days is not None:
+                removed += self.db.execute(
+                    "DELETE FROM charts WHERE last_used < ?", (now - unused_days * 86400,)
+                ).rowcount
+        return removed
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def migrate_legacy_caches(posts: list[Path], cache: ChartCache) -> int:
+    """Import per-post _datawrapper.json files into the shared store.
+
+    Old entries are keyed by CSV text alone, so each post is re-parsed to
+    recover the title and column formats of its tables. Migrated files are
+    renamed to ``*.json.bak``. Returns the number of charts imported.
+    """
+    imported = 0
+    for post in posts:
+        legacy_path = legacy_cache_path(post)
+        if not legacy_path.exists():
+            continue
+        legacy = json.loads(legacy_path.read_text())
+        fm, body = strip_frontmatter(post.read_text())
+        post_title = fm.get("title", post.stem)
+        tables = sorted((t for t in collect_tables(body) if t[3] is not None), key=lambda t: t[1])
+        for position, (_, start, _, table) in enumerate(tables):
+            chart_id = legacy.get(table.to_csv().strip())
+            if chart_id:
+                title = extract_table_title(body, start) or post_title
+                columns = text_column_overrides(table)
+                key = table.cache_key(title, columns)
+                identity = table_identity(post, position, title)
+                cache.put(key, chart_id, title, post, identity=identity, column_format=columns)
+                imported += 1
+            table.close()
+        legacy_path.rename(legacy_path.with_suffix(".json.bak"))
+        print(f"  Migrated {legacy_path}")
+    return imported
+
+
+# ---------------------------------------------------------------------------
+# Main table replacement logic
+# ---------------------------------------------------------------------------
+
+def collect_tables(text: str, index: DocumentIndex | None = None) -> list[tuple[str, int, int, Table | None]]:
+    """Parse every table in the post. Returns (kind, start, end, table) in table order.
+
+    ``table`` is None for interactive HTML tables; tables that fail to parse
+    are reported and left out. Raises TableTooLarge for a table over
+    DW_MAX_ROWS. The caller closes the tables.
+    """
+    index = index or DocumentIndex(text)
+    tables: list[tuple[str, int, int, Table | None]] = []
+    table_num = 0
+    kinds = [("HTML", span) for span in index.html_tables] + [("Markdown", span) for span in index.markdown_tables]
+    try:
+        for kind, (start, end) in kinds:
+            table_num += 1
+            try:
+                if kind == "Markdown":
+                    table = parse_markdown_table(text, start, end)
+                else:
+                    table = None if index.has_nearby_script(end) else parse_html_table(text, start, end)
+            except TableTooLarge as e:
+                raise TableTooLarge(f"Table {table_num} ({kind}) {e}") from None
+            except Exception as e:
+                label = "markdown" if kind == "Markdown" else kind
+                print(f"  ⚠ Table {table_num}: Failed to parse {label} table — {e}")
+                continue
+            if table is None or table.interactive:
+                print(f"  ⚠ Table {table_num}: Interactive HTML table — skipping")
+                if table is not None:
+                    table.close()
+                tables.append((kind, start, end, None))
+            else:
+                tables.append((kind, start, end, table))
+    except TableTooLarge:
+        for *_, table in tables:
+            if table is not None:
+                table.close()
+        raise
+    return tables
+
+
+def publish_table(
+    dw_client: DatawrapperClient,
+    cache: ChartCache,
+    key: str,
+    post_path: Path,
+    identity: str,
+    title: str,
+    table: Table,
+    existing: tuple[str, dict[str, dict]] | None = None,
+) -> str:
+    """Publish one chart, journaling each step. Returns the embed URL.
+
+    ``existing`` is the (chart_id, column_format) of a chart to update in
+    place: only its data is re-uploaded, plus its column formats if they
+    changed. If a previous run was interrupted, resumes after the last
+    journaled step.
+    """
+    columns = text_column_overrides(table)
+    if existing and not cache.journal_get(key):
+        cache.journal_step(key, existing[0], "created", title, post_path)
+
+    chart_id, last_step = cache.journal_get(key) or (None, None)
+    done = PUBLISH_STEPS.index(last_step) + 1 if last_step else 0
+    skip_columns = existing is not None and existing[1] == columns
+    if existing:
+        print(f"  Updating chart {chart_id} for \"{title}\" in place")
+    elif chart_id:
+        print(f"  Resuming chart {chart_id} for \"{title}\" after step '{last_step}'")
+
+    if done < 1:
+        chart_id = dw_client.create_chart(title)
+        cache.journal_step(key, chart_id, "created", title, post_path)
+    if done < 2:
+        dw_client.upload_data(chart_id, table)
+        cache.journal_step(key, chart_id, "data", title, post_path)
+    if done < 3 and not skip_columns:
+        dw_client.set_columns_as_text(chart_id, table, existing[1] if existing else None)
+        cache.journal_step(key, chart_id, "columns", title, post_path)
+    embed_url = dw_client.publish(chart_id)
+    cache.put(key, chart_id, title, post_path, embed_url, identity, columns)
+    return embed_url
+
+
+def gc_orphans(cache: ChartCache, dw_client: DatawrapperClient, delete: bool) -> None:
+    """Report (and optionally delete) charts that were never recorded as published.
+
+    Journaled charts whose publish never finished are deleted with ``delete``.
+    Table charts on the account that the cache has never seen are only listed,
+    since they may have been made by hand.
+    """
+    incomplete = cache.incomplete()
+    print(f"{len(incomplete)} charts created but never recorded:")
+    for key, chart_id, step, title, post in incomplete:
+        print(f"  {chart_id}  \"{title}\" ({post}, stopped after '{step}')")
+        if delete:
+            dw_client.delete_chart(chart_id)
+            cache.forget(key)
+            print(f"    deleted {chart_id}")
+
+    known = cache.known_chart_ids()
+    untracked = [c for c in dw_client.list_charts() if c["id"] not in known and c.get("type") == "tables"]
+    print(f"{len(untracked)} table charts on the account not in the cache (review manually):")
+    for chart in untracked:
+        print(f"  {chart['id']}  \"{chart.get('title', '')}\"")
+
+
+def datawrapper_token() -> str | None:
+    """The Datawrapper API token from the environment or .env."""
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    return os.getenv("DATAWRAPPER_TOKEN")
+
+
+def plan_tables(
+    text: str,
+    post_title: str,
+    post_path: Path,
+    dry_run: bool,
+    concurrency: int = DW_CONCURRENCY,
+    index: DocumentIndex | None = None,
+    session: PrepSession | None = None,
+    cancel: threading.Event | None = None,
+) -> list[tuple[int, int, str]]:
+    """Upload tables to Datawrapper and return (start, end, replacement) edits.
+
+    Uncached tables are published concurrently, at most ``concurrency`` at a
+    time. Edits are sorted by position and never overlap. Interactive tables
+    are replaced with an empty string; they must be handled by hand in Substack.
+    With a ``session``, its client and chart cache are reused and left open.
+    Once ``cancel`` is set, no further uploads start and StagesCancelled
+    is raised.
+    """
+    with trace("parse_tables", "tables") as span:
+        tables = collect_tables(text, index)
+        span["tables"] = len(tables)
+    replacements: list[tuple[int, int, str]] = []
+    # Per table: (start, end, title, table)
+    charts: list[tuple[int, int, str, Table]] = []
+    try:
+        for table_num, (kind, start, end, table) in enumerate(tables, 1):
+            if table is None:
+                replacements.append((start, end, ""))
+                continue
+            chart_title = extract_table_title(text, start) or post_title
+            if dry_run:
+                print(f"  Table {table_num} ({kind}, {len(table)} rows): would upload to Datawrapper as \"{chart_title}\"")
+                preview = table.preview()
+                print(f"    Preview:\n    {preview.replace(chr(10), chr(10) + '    ')}")
+                replacements.append((start, end, f"[DATAWRAPPER EMBED: \"{chart_title}\"]"))
+            else:
+                charts.append((start, end, chart_title, table))
+
+        if charts:
+            from concurrent.futures import ThreadPoolExecutor, as_completed
+
+            if session:
+                dw_client, cache = session.client(), session.cache
+            else:
+                token = datawrapper_token()
+                dw_client = token and DatawrapperClient(token, max_connections=concurrency)
+                cache = ChartCache() if token else None
+            if not dw_client:
+                print("ERROR: DATAWRAPPER_TOKEN not found in .env", file=sys.stderr)
+                print("Tables will be left as-is. Set the token and re-run.", file=sys.stderr)
+                return []
+
+            charts.sort(key=lambda c: c[0])
+            keys = [c[3].cache_key(c[2], text_column_overrides(c[3])) for c in charts]
+            embed_urls: dict[str, str] = {}
+            try:
+                # One upload per distinct table; duplicates share the chart
+                pending: dict[str, tuple] = {}
+                for position, ((_, _, chart_title, table), key) in enumerate(zip(charts, keys)):
+                    if key in embed_urls or key in pending:
+                        continue
+                    identity = table_identity(post_path, position, chart_title)
+                    cached = cache.get(key)
+                    if cached:
+                        embed_urls[key] = cached[1]
+                        cache.link(identity, key)
+                        print(f"  Using cached chart {cached[0]} for \"{chart_title}\"")
+                    else:
+                        existing = cache.identity_chart(identity)
+                        pending[key] = (identity, chart_title, table, existing)
+
+                pool = ThreadPoolExecutor(max_workers=max(1, concurrency))
+                try:
+                    futures = {
+                        pool.submit(publish_table, dw_client, cache, key, post_path, *job): key
+                        for key, job in pending.items()
+                    }
+                    for fut in as_completed(futures):
+                        key = futures[fut]
+                        embed_urls[key] = fut.result()
+                        print(f"  Published {embed_urls[key]} for \"{pending[key][1]}\"")
+                        if cancel is not None and cancel.is_set():
+                            raise StagesCancelled("table uploads cancelled")
+                finally:
+                    # On error, Ctrl-C or cancel, let in-flight steps reach the
+                    # journal but don't start the queued tables
+                    pool.shutdown(wait=True, cancel_futures=True)
+            finally:
+                if not session:
+                    dw_client.close()
+                    cache.close()
+            if not session:
+                dw_client.print_stats()
+
+            for (start, end, *_), key in zip(charts, keys):
+                replacements.append((start, end, f"\n{embed_urls[key]}\n"))
+    finally:
+        for *_, table in tables:
+            if table is not None:
+                table.close()
+
+    replacements.sort(key=lambda r: r[0])
+    return replacements
+
+
+# ---------------------------------------------------------------------------
+# HTML
+# ---------------------------------------------------------------------------
+
+# Document.html writes HTML itself instead of parsing the generated markdown
+# again. Code fences, images, math and footnote refs reach it as atoms the
+# Renderer has already converted, so this only covers the markdown left in
+# prose: the blocks and inline syntax python-markdown's "extra" handles,
+# minus footnotes, abbreviations and definition lists.
+# Atoms are written into the text as "\ue000<index>\ue001", stashed inline
+# markup as "\ue002<index>\ue003" (private-use characters).
+ATOM = re.compile("\ue000(\\d+)\ue001")
+STASHED = re.compile("\ue002(\\d+)\ue003")
+
+ATX_HEADING = re.compile(r"^(#{1,6})[ \t]*(.*?)[ \t]*#*[ \t]*$")
+SETEXT_UNDERLINE = re.compile(r"^(=+|-+)[ \t]*$")
+HR_LINE = re.compile(r"^ {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$")
+LIST_ITEM = re.compile(r"^ {0,3}([*+-]|\d+\.)[ \t]+(.*)$")
+QUOTE_LINE = re.compile(r"^ {0,3}> ?(.*)$")
+INDENTED_LINE = re.compile(r"^(?: {4}|\t)(.*)$")
+TABLE_DELIMITER = re.compile(r"^[ \t]*\|?[ \t]*:?-+:?[ \t]*(?:\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$")
+# Cells split at pipes outside code spans and escapes
+TABLE_CELL_BREAK = re.compile(r"`[^`]*`|\\.|\|")
+HTML_BLOCK_START = re.compile(r"^<([A-Za-z][A-Za-z0-9]*)\b")
+HTML_BLOCK_TAGS = frozenset({
+    "address", "article", "aside", "blockquote", "canvas", "center", "dd", "details", "div",
+    "dl", "dt", "fieldset", "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4",
+    "h5", "h6", "header", "hr", "iframe", "li", "main", "math", "menu", "nav", "noscript",
+    "ol", "p", "pre", "section", "summary", "table", "tbody", "td", "tfoot", "th", "thead",
+    "tr", "ul", "video",
+})
+
+# Inline rules, in the order python-markdown applies them. Earlier rules
+# stash their output so later ones can't rewrite it.
+CODE_SPAN = re.compile(r"(?<!\\)(`+)(.+?)(?<!`)\1(?!`)", re.DOTALL)
+ESCAPED_CHAR = re.compile(r"\\([\\`*_{}\[\]()#+\-.!<>:|])")
+AUTOLINK = re.compile(r"<(https?://[^>\s]+)>|<([^<>\s!]+@[^@<>\s]+)>")
+RAW_INLINE = re.compile(
+    r"</?[A-Za-z][A-Za-z0-9-]*(?:\s[^<>]*)?/?>|&(?:#[0-9]+|#[xX][0-9a-fA-F]+|[A-Za-z][A-Za-z0-9]*);"
+)
+LINK_TEXT = r"\[((?:[^\[\]]|\[[^\[\]]*\])*)\]"
+LINK_TARGET = r"\(\s*<?((?:[^()\s<>]|\([^()\s]*\))*)>?(?:\s+[\"']([^\"']*)[\"'])?\s*\)"
+INLINE_IMAGE = re.compile("!" + LINK_TEXT + LINK_TARGET)
+INLINE_LINK = re.compile(LINK_TEXT + LINK_TARGET)
+
+
+def emphasis_pattern(width: int) -> re.Pattern:
+    """Runs of ``width`` asterisks or underscores around text.
+
+    Asterisks open and close by CommonMark's flanking rules, so the ones in
+    ``0.8*(x) + 0.2*(y)`` are left alone; underscores only work at word
+    edges, as in python-markdown.
+    """
+    star, under = rf"\*{{{width}}}", f"_{{{width}}}"
+    return re.compile(
+        rf"(?:(?<![^\W_]){star}(?=\S)|{star}(?=[^\W_]))(.+?)(?:(?<=[^\W_]){star}|(?<=\S){star}(?![^\W_]))"
+        rf"|(?<!\w){under}(?=\S)(.+?)(?<=\S){under}(?!\w)",
+        re.DOTALL,
+    )
+
+
+EMPHASIS = [
+    (emphasis_pattern(3), "<strong><em>{}</em></strong>"),
+    (emphasis_pattern(2), "<strong>{}</strong>"),
+    (emphasis_pattern(1), "<em>{}</em>"),
+]
+HARD_BREAK = re.compile(r" {2,}\n")
+MARKUP_TAG = re.compile(r"<[^>]*>")
+
+# An atom is (markdown, html, block): block atoms fill a line of their own
+Atom = tuple[str, str, bool]
+
+
+def escape_text(text: str) -> str:
+    return html.escape(text, quote=False)
+
+
+def escape_code(code: str) -> str:
+    """Escape a code block's text the way python-markdown does (quotes too)."""
+    return escape_text(code).replace('"', "&quot;")
+
+
+def fence_html(fence: str) -> str:
+    """A fenced code block as <pre><code>, its language as a class."""
+    first, _, rest = fence.partition("\n")
+    code = rest.rpartition("\n")[0] if "\n" in rest else ""
+    lang = first.strip("`~ \t").strip("{}. ")
+    attrs = f' class="language-{html.escape(lang)}"' if lang else ""
+    return f"<pre><code{attrs}>{escape_code(code)}{chr(10) if code else ''}</code></pre>"
+
+
+def image_html(alt: str, url: str) -> str:
+    return f'<img alt="{html.escape(alt)}" src="{html.escape(url)}" />'
+
+
+def expand_atoms(text: str, atoms: Sequence[Atom], form: int = 0) -> str:
+    """text with each atom written out as markdown (form 0) or HTML (form 1)."""
+    return ATOM.sub(lambda m: atoms[int(m.group(1))][form], text)
+
+
+def inline_html(text: str, atoms: Sequence[Atom]) -> str:
+    """HTML for the inline markdown in one block of text."""
+    stash: list[str] = []
+
+    def hold(markup: str) -> str:
+        stash.append(markup)
+        return f"\ue002{len(stash) - 1}\ue003"
+
+    def unstash(text: str) -> str:
+        while "\ue002" in text:
+            text = STASHED.sub(lambda m: stash[int(m.group(1))], text)
+        return text
+
+    def image(m: re.Match) -> str:
+        alt = html.unescape(MARKUP_TAG.sub("", unstash(escape_text(m.group(1)))))
+        title = f' title="{html.escape(m.group(3))}"' if m.group(3) else ""
+        return hold(f'<img alt="{html.escape(alt)}" src="{html.escape(m.group(2))}"{title} />')
+
+    def link(m: re.Match) -> str:
+        title = f' title="{html.escape(m.group(3))}"' if m.group(3) else ""
+        opening = hold(f'<a href="{html.escape(m.group(2))}"{title}>')
+        return f"{opening}{m.group(1)}{hold('</a>')}"
+
+    def autolink(m: re.Match) -> str:
+        url = m.group(1) or f"mailto:{m.group(2)}"
+        return hold(f'<a href="{html.escape(url)}">{escape_text(m.group(1) or m.group(2))}</a>')
+
+    text = CODE_SPAN.sub(
+        lambda m: hold(f"<code>{escape_text(expand_atoms(m.group(2).strip(), atoms))}</code>"), text
+    )
+    text = ESCAPED_CHAR.sub(lambda m: hold(escape_text(m.group(1))), text)
+    text = AUTOLINK.sub(autolink, text)
+    text = RAW_INLINE.sub(lambda m: hold(m.group()), text)
+    text = INLINE_IMAGE.sub(image, text)
+    text = INLINE_LINK.sub(link, text)
+    text = escape_text(text)
+    for pattern, markup in EMPHASIS:
+        text = pattern.sub(lambda m: markup.format(m.group(1) or m.group(2)), text)
+    text = HARD_BREAK.sub("<br />\n", text)
+    return expand_atoms(unstash(text), atoms, 1)
+
+
+def table_cells(line: str) -> list[str]:
+    row = line.strip()
+    if row.startswith("|"):
+        row = row[1:]
+    if row.endswith("|") and not row.endswith("\\|"):
+        row = row[:-1]
+    cells, start = [], 0
+    for m in TABLE_CELL_BREAK.finditer(row):
+        if m.group() == "|":
+            cells.append(row[start:m.start()].strip())
+            start = m.end()
+    cells.append(row[start:].strip())
+    return cells
+
+
+def table_html(rows: list[str], atoms: Sequence[Atom]) -> str:
+    """A pipe table (header, delimiter, body rows) as an HTML table."""
+    header = table_cells(rows[0])
+    aligns = []
+    for spec in table_cells(rows[1])[:len(header)]:
+        if spec.startswith(":") and spec.endswith(":"):
+            aligns.append(' style="text-align: center;"')
+        elif spec.endswith(":"):
+            aligns.append(' style="text-align: right;"')
+        elif spec.startswith(":"):
+            aligns.append(' style="text-align: left;"')
+        else:
+            aligns.append("")
+    aligns += [""] * (len(header) - len(aligns))
+
+    def row_html(cells: list[str], tag: str) -> str:
+        cells = (cells + [""] * len(header))[:len(header)]
+        return "<tr>\n" + "".join(
+            f"<{tag}{align}>{inline_html(cell, atoms)}</{tag}>\n" for cell, align in zip(cells, aligns)
+        ) + "</tr>"
+
+    body = [row_html(table_cells(row), "td") for row in rows[2:]]
+    return "\n".join([
+        "<table>", "<thead>", row_html(header, "th"), "</thead>",
+        *(["<tbody>", *body, "</tbody>"] if body else []), "</table>",
+    ])
+
+
+def next_filled(lines: list[str], i: int) -> int:
+    """Index of the first non-blank line at or after i (len(lines) if none)."""
+    while i < len(lines) and not lines[i].strip():
+        i += 1
+    return i
+
+
+def next_blank(lines: list[str], i: int) -> int:
+    """Index of the first blank line at or after i (len(lines) if none)."""
+    while i < len(lines) and lines[i].strip():
+        i += 1
+    return i
+
+
+def list_html(lines: list[str], i: int, atoms: Sequence[Atom]) -> tuple[str, int]:
+    """Render the list starting at lines[i]. Returns (html, index after it).
+
+    As in python-markdown, an item next to a blank line is loose: its
+    paragraphs keep their <p> tags.
+    """
+    ordered = LIST_ITEM.match(lines[i]).group(1)[0].isdigit()
+    # (lines, [loose, nested list started]) per item
+    items: list[tuple[list[str], list[bool]]] = []
+    loose_next = False
+    while i < len(lines):
+        line = lines[i]
+        item = LIST_ITEM.match(line)
+        if item and item.group(1)[0].isdigit() == ordered:
+            items.append(([item.group(2)], [loose_next, False]))
+            loose_next = False
+        elif not line.strip():
+            following = next_filled(lines, i)
+            if following == len(lines):
+                break
+            nxt = LIST_ITEM.match(lines[following])
+            if nxt and nxt.group(1)[0].isdigit() == ordered:
+                loose_next = True
+            elif not INDENTED_LINE.match(lines[following]):
+                break
+            items[-1][1][0] = True
+            items[-1][0].append("")
+        elif INDENTED_LINE.match(line):
+            inner = INDENTED_LINE.match(line).group(1)
+            item_lines, flags = items[-1]
+            # A nested list starts a block of its own within the item
+            if LIST_ITEM.match(inner) and not flags[1]:
+                flags[1] = True
+                if item_lines[-1]:
+                    item_lines.append("")
+            item_lines.append(inner)
+        elif lines[i - 1].strip():
+            # Lazy continuation of the item's paragraph
+            items[-1][0].append(line)
+        else:
+            break
+        i += 1
+
+    tag = "ol" if ordered else "ul"
+    out = [f"<{tag}>"]
+    for item_lines, (loose, _) in items:
+        inner = markdown_html("\n".join(item_lines), atoms)
+        if loose:
+            out.append(f"<li>\n{inner}\n</li>")
+            continue
+        if inner.startswith("<p>"):
+            para_end = inner.index("</p>")
+            rest = inner[para_end + 5:]
+            inner = inner[3:para_end] + (f"{rest}\n" if rest else "")
+        out.append(f"<li>{inner}</li>")
+    out.append(f"</{tag}>")
+    return "\n".join(out), i
+
+
+def html_block_end(lines: list[str], i: int, tag: str) -> int:
+    """Index after a raw HTML block: through its closing tag, else to a blank line."""
+    opening = re.compile(rf"<{tag}\b", re.IGNORECASE)
+    closing = re.compile(rf"</{tag}\s*>", re.IGNORECASE)
+    depth = 0
+    for j in range(i, len(lines)):
+        depth += len(opening.findall(lines[j])) - len(closing.findall(lines[j]))
+        if depth <= 0:
+            return j + 1
+    return next_blank(lines, i)
+
+
+def interrupts_paragraph(line: str, atoms: Sequence[Atom]) -> bool:
+    """Whether line starts a new block even without a blank line before it."""
+    atom = ATOM.fullmatch(line)
+    return bool(
+        atom and atoms[int(atom.group(1))][2]
+        or ATX_HEADING.match(line)
+        or HR_LINE.match(line)
+        or QUOTE_LINE.match(line)
+    )
+
+
+def markdown_html(text: str, atoms: Sequence[Atom]) -> str:
+    """HTML for the markdown in text, blocks separated by newlines."""
+    lines = text.split("\n")
+    out: list[str] = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not line.strip():
+            i += 1
+            continue
+        atom = ATOM.fullmatch(line.strip())
+        html_start = HTML_BLOCK_START.match(line)
+        if atom and atoms[int(atom.group(1))][2]:
+            out.append(atoms[int(atom.group(1))][1])
+            i += 1
+        elif ATX_HEADING.match(line):
+            level, heading = ATX_HEADING.match(line).groups()
+            out.append(f"<h{len(level)}>{inline_html(heading, atoms)}</h{len(level)}>")
+            i += 1
+        elif HR_LINE.match(line):
+            out.append("<hr />")
+            i += 1
+        elif INDENTED_LINE.match(line):
+            end = i
+            while end < len(lines) and (INDENTED_LINE.match(lines[end]) or not lines[end].strip()):
+                end += 1
+            while not lines[end - 1].strip():
+                end -= 1
+            code = "\n".join(INDENTED_LINE.sub(r"\1", row) for row in lines[i:end])
+            out.append(f"<pre><code>{escape_code(code)}\n</code></pre>")
+            i = end
+        elif LIST_ITEM.match(line):
+            block, i = list_html(lines, i, atoms)
+            out.append(block)
+        elif QUOTE_LINE.match(line):
+            end = next_blank(lines, i)
+            # Quotes split only by blank lines are one blockquote
+            following = next_filled(lines, end)
+            while following < len(lines) and QUOTE_LINE.match(lines[following]):
+                end = next_blank(lines, following)
+                following = next_filled(lines, end)
+            quoted = [QUOTE_LINE.sub(r"\1", row) for row in lines[i:end]]
+            out.append(f"<blockquote>\n{markdown_html(chr(10).join(quoted), atoms)}\n</blockquote>")
+            i = end
+        elif html_start and html_start.group(1).lower() in HTML_BLOCK_TAGS:
+            end = html_block_end(lines, i, html_start.group(1))
+            # python-markdown leaves a blank line after raw HTML
+            out.append("\n".join(lines[i:end]) + "\n")
+            i = end
+        elif "|" in line and i + 1 < len(lines) and "|" in lines[i + 1] and TABLE_DELIMITER.match(lines[i + 1]):
+            end = next_blank(lines, i)
+            out.append(table_html(lines[i:end], atoms))
+            i = end
+        else:
+            end = i + 1
+            if end < len(lines) and SETEXT_UNDERLINE.match(lines[end]):
+                level = 1 if lines[end].startswith("=") else 2
+                out.append(f"<h{level}>{inline_html(line.strip(), atoms)}</h{level}>")
+                i = end + 1
+                continue
+            while end < len(lines) and lines[end].strip() and not interrupts_paragraph(lines[end], atoms):
+                end += 1
+            out.append(f"<p>{inline_html(chr(10).join(lines[i:end]).lstrip(), atoms)}</p>")
+            i = end
+    return "\n".join(out).rstrip("\n")
+
+
+# ---------------------------------------------------------------------------
+# Pipeline
+# ---------------------------------------------------------------------------
+
+# Code fences pass through untouched so later rules can't rewrite code.
+CODE_FENCE = re.compile(r"^```.*?^```[^\n]*$", re.MULTILINE | re.DOTALL)
+# So do inline code spans, so a [^1] or $x$ written as code stays code
+INLINE_CODE = re.compile(r"``[^\n]+?``|`[^`\n]+`")
+BLANK_RUNS = re.compile(r"\n{4,}")
+
+
+def combine_patterns(named: list[tuple[str, re.Pattern]]) -> re.Pattern:
+    """Join stage patterns into one alternation, keeping each one's flags.
+
+    Earlier entries win when two patterns match at the same position, which
+    mirrors the order the stages used to run in.
+    """
+    parts = []
+    for name, pattern in named:
+        flags = "".join(
+            letter
+            for flag, letter in ((re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"))
+            if pattern.flags & flag
+        )
+        parts.append(f"(?P<{name}>(?{flags}:{pattern.pattern}))" if flags
+                     else f"(?P<{name}>{pattern.pattern})")
+    return re.compile("|".join(parts))
+
+
+TOKENS = combine_patterns([
+    ("fence", CODE_FENCE),
+    ("code", INLINE_CODE),
+    ("script", SCRIPT_BLOCK),
+    ("comment", HTML_COMMENT),
+    ("fn_header", FOOTNOTES_HEADER),
+    ("fn_def", FOOTNOTE_DEF),
+    ("image", IMAGE_SHORTCODE),
+    ("tag", NUNJUCKS_TAG),
+    ("expr", NUNJUCKS_EXPR),
+    ("block_math", BLOCK_MATH),
+    ("inline_math", INLINE_MATH),
+    ("fn_ref", FOOTNOTE_REF),
+    ("stray_tag", STRAY_TAG),
+])
+FOOTNOTE_TOKENS = {"fn_header", "fn_def", "fn_ref"}
+DROPPED_TOKENS = {"script", "comment", "fn_header", "tag", "expr", "stray_tag"}
+
+
+class Renderer:
+    """Single-pass scanner that turns an Eleventy body into Substack markdown.
+
+    Each span is classified once by ``TOKENS`` and written to one output
+    buffer, so text produced for one span is never rescanned by another rule.
+    Code, images, math and footnote refs are written as atoms holding both
+    their markdown and their HTML, so ``Document.html`` doesn't parse them.
+    """
+
+    def __init__(self, url_map: dict[str, str], math_map: dict[tuple[str, bool], str] | None = None) -> None:
+        self.url_map = url_map
+        self.math_map = math_map or {}
+        self.parts: list[str] = []
+        self.definitions: dict[str, str] = {}
+        # (atom index, name) of each footnote ref, numbered by collect_notes()
+        self.refs: list[tuple[int, str]] = []
+        self.atoms: list[Atom] = []
+        self.counts: dict[str, int] = defaultdict(int)
+        # Indexes into parts reserved by slot(), and the notes from collect_notes()
+        self.slots: list[int] = []
+        self.notes: list[str] = []
+        # Index into parts just after the last dropped non-footnote artifact.
+        # Endnotes are joined after trimming only what follows it, as when
+        # footnotes were converted before artifacts were stripped.
+        self.tail_start = 0
+
+    def feed(self, text: str, start: int = 0, end: int | None = None, note: bool = False) -> None:
+        """Scan text[start:end] and append its rendering to the buffer."""
+        end = len(text) if end is None else end
+        pos = start
+        for m in TOKENS.finditer(text, start, end):
+            kind = m.lastgroup
+            self.counts[kind] += 1
+            self.parts.append(text[pos:m.start()])
+            pos = m.end()
+            if kind in DROPPED_TOKENS:
+                if kind not in FOOTNOTE_TOKENS:
+                    self.tail_start = len(self.parts)
+                continue
+            if kind == "fence":
+                self.atom(m.group(), fence_html(m.group()), block=True)
+            elif kind == "code":
+                self.parts.append(m.group())
+            elif kind == "image":
+                alt, url = resolve_image(IMAGE_SHORTCODE.match(m.group()), self.url_map)
+                self.atom(f"![{alt}]({url})", image_html(alt, url))
+            elif kind in ("block_math", "inline_math"):
+                display = kind == "block_math"
+                match = (BLOCK_MATH if display else INLINE_MATH).match(m.group())
+                formula = match.group(1).strip()
+                if (formula, display) in self.math_map:
+                    uri = self.math_map[formula, display]
+                    self.atom(formula_image(formula, uri), image_html(" ".join(formula.split()), uri))
+                else:
+                    marker = latex_block(match) if display else latex_inline(match)
+                    self.atom(marker, escape_text(marker))
+            elif kind == "fn_def":
+                name, raw = FOOTNOTE_DEF.match(m.group()).groups()
+                self.definitions[name] = footnote_body(raw)
+            elif kind == "fn_ref":
+                # Refs inside a note body are left as written
+                if note:
+                    self.parts.append(m.group())
+                    continue
+                # Written as is until collect_notes() has seen every definition
+                self.refs.append((len(self.atoms), FOOTNOTE_REF.match(m.group()).group(1)))
+                self.atom(m.group(), escape_text(m.group()))
+        self.parts.append(text[pos:end])
+
+    def atom(self, markdown: str, markup: str, block: bool = False) -> None:
+        """Append a span whose markdown and HTML are both already known."""
+        self.parts.append(f"\ue000{len(self.atoms)}\ue001")
+        self.atoms.append((markdown, markup, block))
+
+    def write(self, text: str) -> None:
+        """Append text verbatim."""
+        self.parts.append(text)
+
+    def slot(self) -> None:
+        """Reserve a place for text that is only known later, like a table's embed."""
+        self.slots.append(len(self.parts))
+        self.parts.append("")
+
+    def collect_notes(self) -> None:
+        """Number the footnote refs and render each note, in number order.
+
+        Notes are numbered by first reference. A ref without a definition
+        stays literal text rather than pointing at an empty note.
+        """
+        numbers: dict[str, int] = {}
+        uses: dict[int, int] = defaultdict(int)
+        missing: set[str] = set()
+        for index, name in self.refs:
+            if name in self.definitions:
+                num = numbers.setdefault(name, len(numbers) + 1)
+                uses[num] += 1
+                self.atoms[index] = (to_superscript(num), footnote_anchor(num, uses[num]), False)
+            elif name not in missing:
+                missing.add(name)
+                print(f"  ⚠ Footnote [^{name}] has no definition; left as written")
+        for name in numbers:
+            start = len(self.parts)
+            self.feed(self.definitions[name], note=True)
+            self.notes.append("".join(self.parts[start:]))
+            del self.parts[start:]
+
+    def document(self, fills: Sequence[str] = ()) -> Document:
+        """Finish the document: fill slots in order and normalize whitespace.
+
+        Call after ``collect_notes``. The renderer is left unchanged, so
+        one scan can be finished with different fills.
+        """
+        parts = list(self.parts)
+        for i, text in zip(self.slots, fills):
+            parts[i] = text
+        if self.notes:
+            head = "".join(parts[:self.tail_start])
+            tail = "".join(parts[self.tail_start:]).rstrip()
+            parts = [head, tail]
+        # Clean up excessive blank lines; the end is trimmed with the notes
+        return Document(BLANK_RUNS.sub("\n\n\n", "".join(parts)).lstrip(), self.notes, list(self.atoms))
+
+
+HTML_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<style>
+  body {{ font-family: -apple-system, Georgia, serif; max-width: 680px; margin: 2em auto; padding: 0 1em; line-height: 1.6; color: #1a1a1a; }}
+  img {{ max-width: 100%; height: auto; }}
+  a {{ color: #0366d6; }}
+  hr {{ border: none; border-top: 1px solid #ddd; margin: 2em 0; }}
+  p {{ margin: 1em 0; }}
+</style>
+</head>
+<body>
+{body}
+</body>
+</html>"""
+
+
+class Document:
+    """A rendered post that both output formats are written from.
+
+    ``body`` is the Substack markdown without its notes, and ``notes[n - 1]``
+    is the markdown of note n; both hold atoms (see ``Renderer.atom``) that
+    each format writes out in its own form. Keeping the notes apart means
+    the HTML never re-parses generated markdown to find them again.
+    ``tables_left`` counts tables ``transform`` left in place because no
+    Datawrapper token was set.
+    """
+
+    def __init__(self, body: str, notes: list[str], atoms: list[Atom] | None = None) -> None:
+        self.body = body
+        self.notes = notes
+        self.atoms = atoms or []
+        self.tables_left = 0
+
+    def markdown(self) -> str:
+        """The post as Substack markdown, renumbered notes at the end."""
+        parts = [self.body]
+        if self.notes:
+            parts.append(NOTES_HEADER)
+            parts += [footnote_endnote(num, note) for num, note in enumerate(self.notes, 1)]
+        text = expand_atoms("".join(parts), self.atoms)
+        return BLANK_RUNS.sub("\n\n\n", text).strip() + "\n"
+
+    def html(self) -> str:
+        """The post as an HTML page for rich-text copy-paste.
+
+        Footnotes come out as Substack's own footnote markup, so they paste
+        in as native footnotes.
+        """
+        with trace("markdown_to_html") as span:
+            parts = [markdown_html(self.body, self.atoms)]
+            parts += [
+                footnote_note(num, markdown_html(note, self.atoms)) for num, note in enumerate(self.notes, 1)
+            ]
+            body_html = "\n".join(parts)
+            if TRACER is not None:
+                span.update(input_bytes=utf8_len(self.body), output_bytes=utf8_len(body_html))
+        return HTML_PAGE.format(body=body_html)
+
+
+def find_formulas(text: str) -> list[tuple[str, bool]]:
+    """(formula, display) for each formula the Renderer would convert, in order."""
+    formulas = []
+    for m in TOKENS.finditer(text):
+        if m.lastgroup == "block_math":
+            formulas.append((BLOCK_MATH.match(m.group()).group(1).strip(), True))
+        elif m.lastgroup == "inline_math":
+            formulas.append((INLINE_MATH.match(m.group()).group(1).strip(), False))
+        elif m.lastgroup == "fn_def":
+            formulas += find_formulas(footnote_body(FOOTNOTE_DEF.match(m.group()).group(2)))
+    return formulas
+
+
+class StageCache:
+    """Memo of the latest output of each pipeline stage, keyed by its inputs.
+
+    A stage re-runs only when the hash of its inputs changes, so a watch
+    session rebuilding after a prose edit skips tables and image lookups.
+    Different stages may be looked up from different threads.
+    """
+
+    def __init__(self) -> None:
+        self.entries: dict[str, tuple[str, object]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, stage: str, inputs: object, compute: Callable[[], object]) -> object:
+        key = hashlib.sha256(repr(inputs).encode("utf-8")).hexdigest()
+        entry = self.entries.get(stage)
+        with trace(stage) as span:
+            if entry and entry[0] == key:
+                with self.lock:
+                    self.hits += 1
+                span["cached"] = True
+                return entry[1]
+            with self.lock:
+                self.misses += 1
+            value = compute()
+            if TRACER is not None and isinstance(value, str):
+                span["output_bytes"] = utf8_len(value)
+        self.entries[stage] = (key, value)
+        return value
+
+    def digests(self) -> dict[str, str]:
+        """Short hash of each stage's latest output (plain data only), for the catalog."""
+        return {
+            stage: hashlib.sha256(repr(value).encode("utf-8")).hexdigest()[:16]
+            for stage, (_, value) in self.entries.items()
+            if isinstance(value, (str, list, dict))
+        }
+
+
+class SerializedOutput(io.TextIOBase):
+    """Stand-in for sys.stdout while several threads print.
+
+    Each thread's writes are held until they end a line, then written out
+    under a lock, so a print lands whole instead of interleaving with
+    another thread's (print writes its text and its newline separately).
+    """
+
+    def __init__(self, stream: TextIO) -> None:
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.held: dict[int, str] = {}  # thread id -> text of an unfinished line
+
+    def write(self, text: str) -> int:
+        thread = threading.get_ident()
+        line = self.held.pop(thread, "") + text
+        if line.endswith("\n"):
+            with self.lock:
+                self.stream.write(line)
+        else:
+            self.held[thread] = line
+        return len(text)
+
+    def flush(self) -> None:
+        with self.lock:
+            self.stream.flush()
+
+    def close(self) -> None:
+        """Write out any unfinished lines."""
+        with self.lock:
+            for line in self.held.values():
+                self.stream.write(line)
+            self.held.clear()
+        super().close()
+
+
+class StagesCancelled(Exception):
+    """Raised by a stage that stopped early because its run was cancelled."""
+
+
+def run_stages(
+    stages: dict[str, tuple[tuple[str, ...], Callable[[dict], object]]],
+    cancel: threading.Event | None = None,
+) -> dict[str, object]:
+    """Run stages on threads, each as soon as the stages it depends on finish.
+
+    ``stages`` maps a name to (dependency names, function); the function is
+    called with the results so far, keyed by stage name. Returns every
+    stage's result; the first stage to fail raises once everything already
+    running has finished. While they run, stdout is a SerializedOutput.
+
+    Ctrl-C only reaches the main thread, so on any failure (including
+    KeyboardInterrupt) ``cancel`` is set before waiting for running stages;
+    long stages check it and stop early.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    results: dict[str, object] = {}
+    pending = dict(stages)
+    stdout = sys.stdout
+    sys.stdout = output = SerializedOutput(stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=len(stages)) as pool:
+            running: dict = {}
+            try:
+                while pending or running:
+                    for name, (deps, fn) in list(pending.items()):
+                        if all(dep in results for dep in deps):
+                            running[pool.submit(fn, results)] = name
+                            del pending[name]
+                    if not running:
+                        raise ValueError(f"stages with unknown dependencies: {', '.join(pending)}")
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        results[running.pop(fut)] = fut.result()
+            except BaseException:
+                if cancel is not None:
+                    cancel.set()
+                raise
+    finally:
+        sys.stdout = stdout
+        output.close()
+    return results
+
+
+class PrepSession:
+    """Long-lived resources shared by every prep in one process.
+
+    The chart cache, Datawrapper connection pool, image indexes and
+    per-post stage memos stay warm between posts. Not thread-safe: callers
+    serialize preps with ``lock``.
+    """
+
+    def __init__(self, concurrency: int = DW_CONCURRENCY) -> None:
+        self.concurrency = concurrency
+        self.cache = ChartCache()
+        self.dw_client: DatawrapperClient | None = None
+        self.image_indexes: dict[Path, ImageIndex] = {}
+        self.memos: dict[Path, StageCache] = {}
+        self.lock = threading.Lock()
+
+    def client(self) -> DatawrapperClient | None:
+        """The shared Datawrapper client, created on first use."""
+        if self.dw_client is None:
+            token = datawrapper_token()
+            if token:
+                self.dw_client = DatawrapperClient(token, max_connections=self.concurrency)
+        return self.dw_client
+
+    def image_index(self, post_path: Path) -> ImageIndex:
+        root = find_project_root(post_path)
+        if root not in self.image_indexes:
+            self.image_indexes[root] = ImageIndex(root)
+        return self.image_indexes[root]
+
+    def memo(self, post_path: Path) -> StageCache:
+        return self.memos.setdefault(post_path.resolve(), StageCache())
+
+    def close(self) -> None:
+        for index in self.image_indexes.values():
+            index.save()
+        if self.dw_client:
+            self.dw_client.close()
+        self.cache.close()
+
+
+def file_stamp(path: Path) -> tuple[int, int] | None:
+    """(mtime_ns, size) of a file, or None if it doesn't exist."""
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def image_inputs(body: str, post_path: Path) -> tuple:
+    """Everything resolve_image_urls depends on: shortcodes, sources, rendered page."""
+    project_root = find_project_root(post_path)
+    rendered = project_root / "_site" / "blog" / post_path.parent.name / "index.html"
+    sources = [m.group(1).strip().strip("\"'") for m in IMAGE_SHORTCODE.finditer(body)]
+    return (
+        IMAGE_SHORTCODE.findall(body),
+        [file_stamp(post_path.parent / src) for src in sources],
+        file_stamp(rendered),
+    )
+
+
+def scan_body(
+    body: str,
+    spans: list[tuple[int, int]],
+    url_map: dict[str, str],
+    math_map: dict[tuple[str, bool], str],
+    edits: list[tuple[int, int, str]] | None = None,
+) -> Renderer:
+    """Scan a post body with its notes collected.
+
+    Without ``edits``, every table span becomes a slot for its replacement;
+    with them, each (start, end, replacement) is written in place.
+    """
+    renderer = Renderer(url_map, math_map)
+    pos = 0
+    for start, end, replacement in edits if edits is not None else [(*span, None) for span in spans]:
+        renderer.feed(body, pos, start)
+        if replacement is None:
+            renderer.slot()
+        else:
+            renderer.write(replacement)
+        pos = end
+    renderer.feed(body, pos)
+    renderer.collect_notes()
+    if TRACER is not None:
+        trace_note(input_bytes=utf8_len(body), matches=dict(renderer.counts))
+    return renderer
+
+
+def transform(
+    text: str,
+    post_path: Path,
+    dry_run: bool,
+    concurrency: int = DW_CONCURRENCY,
+    memo: StageCache | None = None,
+    session: PrepSession | None = None,
+    math: MathImages | None = None,
+) -> Document:
+    """Run all transformations on the post content.
+
+    Pass a ``StageCache`` shared between calls to skip stages whose inputs
+    haven't changed since the last call, and a ``PrepSession`` to reuse a
+    warm Datawrapper client, chart cache and image index. With ``math``,
+    formulas are rendered to local images instead of [LATEX: ...] markers.
+
+    Table uploads, image lookups and formula rendering run
+    concurrently; the text scan starts once the image and formula URLs are
+    known and leaves slots for table embeds, which are filled at the end.
+    """
+    memo = memo or StageCache()
+    with trace("frontmatter"):
+        fm, body = strip_frontmatter(text)
+    title = fm.get("title", post_path.stem)
+
+    print(f"Post: {title}")
+    print(f"Processing tables...")
+    # Table edits depend only on the tables, their titles and nearby scripts,
+    # and on whether a token lets them be uploaded at all (so adding one to
+    # .env during --watch retries them); they're memoized by table order so
+    # prose edits that shift positions still hit the cache.
+    with trace("index") as span:
+        index = DocumentIndex(body)
+        spans = sorted(index.html_tables + index.markdown_tables)
+        has_token = bool(spans) and not dry_run and bool(datawrapper_token())
+        table_inputs = (title, dry_run, has_token, [
+            (span_digest(body, start, end), extract_table_title(body, start), index.has_nearby_script(end))
+            for start, end in spans
+        ])
+        span["tables"] = len(spans)
+
+    # Set if the run fails or is interrupted, so queued uploads don't start
+    cancel = threading.Event()
+
+    def run_tables() -> list[tuple[int, str]]:
+        order = {span: i for i, span in enumerate(spans)}
+        edits = plan_tables(body, title, post_path, dry_run, concurrency, index, session, cancel)
+        trace_note(replacements=len(edits))
+        return [(order[start, end], replacement) for start, end, replacement in edits]
+
+    print("Converting images, math, footnotes; stripping Nunjucks and HTML artifacts...")
+    image_index = session.image_index(post_path) if session else None
+    images = image_inputs(body, post_path)
+    formulas = find_formulas(body) if math else []
+    if math:
+        print(f"Rendering math with {math.renderer} ({math.fmt})...")
+
+    def run_images(_: dict) -> dict[str, str]:
+        return memo.get("images", images, lambda: resolve_image_urls(post_path, body, image_index))
+
+    def run_math(_: dict) -> dict[tuple[str, bool], str]:
+        if not math:
+            return {}
+        return memo.get("math", (math.renderer, math.fmt, formulas), lambda: math.render(formulas, post_path))
+
+    def run_text(done: dict) -> Renderer:
+        url_map, math_map = done["images"], done["math"]
+        return memo.get(
+            "render", (body, spans, sorted(url_map.items()), sorted(math_map.items())),
+            lambda: scan_body(body, spans, url_map, math_map),
+        )
+
+    # Each stage owns its own regions of the document: tables their spans,
+    # the text scan everything between them. Only the scan waits, on the
+    # image and formula URLs it writes; table uploads overlap all of it.
+    results = run_stages({
+        "tables": ((), lambda _: memo.get("tables", table_inputs, run_tables)),
+        "images": ((), run_images),
+        "math": ((), run_math),
+        "text": (("images", "math"), run_text),
+    }, cancel)
+    edits = [(*spans[i], r) for i, r in results["tables"]]
+    with trace("merge"):
+        if [(start, end) for start, end, _ in edits] == spans:
+            return results["text"].document([r for _, _, r in edits])
+        # Some tables were left in place (no Datawrapper token): scan again
+        # with the edits that were made
+        doc = scan_body(body, spans, results["images"], results["math"], edits).document()
+        doc.tables_left = len(spans) - len(edits)
+        return doc
+
+
+# ---------------------------------------------------------------------------
+# Post catalog
+# ---------------------------------------------------------------------------
+
+SINCE_AGO = re.compile(r"(\d+(?:\.\d+)?)([dhm])")
+SINCE_UNITS = {"d": 86400, "h": 3600, "m": 60}
+
+
+def since_timestamp(value: str) -> float:
+    """Parse --changed-since: an ISO date/time (local) or an age like 7d, 12h, 30m."""
+    from datetime import datetime
+
+    m = SINCE_AGO.fullmatch(value)
+    if m:
+        return time.time() - float(m.group(1)) * SINCE_UNITS[m.group(2)]
+    return datetime.fromisoformat(value).timestamp()
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def catalog_key(post: Path) -> str:
+    """Catalog key for a post: its path relative to the project when inside it."""
+    path = post.resolve()
+    return str(path.relative_to(PROJECT_ROOT)) if path.is_relative_to(PROJECT_ROOT) else str(path)
+
+
+def frontmatter_tags(fm: dict) -> list[str]:
+    tags = fm.get("tags") or []
+    return [str(t) for t in ([tags] if isinstance(tags, str) else tags)]
+
+
+class PostCatalog:
+    """Every post seen, with its frontmatter and what its last prep produced.
+
+    Rows are refreshed by mtime and size, so only edited posts are re-read.
+    ``changed`` is the file's mtime when its content hash last changed.
+    ``prepped_hash`` and ``published_hash`` are the content hashes at the
+    last successful prep and the last one that published (not a dry run);
+    ``outputs`` holds that prep's per-stage output hashes.
+    """
+
+    def __init__(self, path: Path | None = None) -> None:
+        self.db = sqlite3.connect(path or CATALOG_DB, timeout=30.0)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS posts (
+                    path TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    changed REAL NOT NULL,
+                    title TEXT,
+                    date TEXT,
+                    tags TEXT NOT NULL,
+                    frontmatter TEXT NOT NULL,
+                    prepped REAL,
+                    prepped_hash TEXT,
+                    published REAL,
+                    published_hash TEXT,
+                    outputs TEXT
+                )"""
+            )
+
+    def refresh(self, posts: list[Path]) -> int:
+        """Re-read posts whose mtime or size changed and drop rows for deleted files.
+
+        Returns the number of posts re-read.
+        """
+        known = {
+            row[0]: row[1:]
+            for row in self.db.execute("SELECT path, mtime, size, content_hash FROM posts")
+        }
+        seen: set[str] = set()
+        reread = 0
+        with self.db:
+            for post in posts:
+                key = catalog_key(post)
+                seen.add(key)
+                try:
+                    stat = post.stat()
+                    row = known.get(key)
+                    if row and row[:2] == (stat.st_mtime, stat.st_size):
+                        continue
+                    text = post.read_text()
+                except OSError:
+                    continue
+                reread += 1
+                digest = content_hash(text)
+                if row and row[2] == digest:
+                    # Touched but not edited
+                    self.db.execute("UPDATE posts SET mtime = ?, size = ? WHERE path = ?",
+                                    (stat.st_mtime, stat.st_size, key))
+                    continue
+                try:
+                    fm = strip_frontmatter(text)[0]
+                except Exception as e:
+                    print(f"  ⚠ {post}: unreadable frontmatter ({type(e).__name__})")
+                    fm = {}
+                self.db.execute(
+                    """INSERT INTO posts (path, mtime, size, content_hash, changed, title, date, tags, frontmatter)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT (path) DO UPDATE SET
+                           mtime = excluded.mtime, size = excluded.size,
+                           content_hash = excluded.content_hash, changed = excluded.changed,
+                           title = excluded.title, date = excluded.date, tags = excluded.tags,
+                           frontmatter = excluded.frontmatter""",
+                    (key, stat.st_mtime, stat.st_size, digest, stat.st_mtime,
+                     fm.get("title"), str(fm["date"]) if fm.get("date") else None,
+                     json.dumps(frontmatter_tags(fm)), json.dumps(fm, default=str, sort_keys=True)),
+                )
+            gone = [key for key in known.keys() - seen if not (PROJECT_ROOT / key).exists()]
+            self.db.executemany("DELETE FROM posts WHERE path = ?", [(key,) for key in gone])
+        return reread
+
+    def rows(self, posts: list[Path]) -> dict[Path, dict]:
+        """Catalog rows for the given (refreshed) posts, as dicts keyed by post."""
+        self.db.row_factory = sqlite3.Row
+        try:
+            by_key = {row["path"]: dict(row) for row in self.db.execute("SELECT * FROM posts")}
+        finally:
+            self.db.row_factory = None
+        return {post: by_key[catalog_key(post)] for post in posts if catalog_key(post) in by_key}
+
+    def select(
+        self,
+        posts: list[Path],
+        changed_since: float | None = None,
+        stale: bool = False,
+        tags: list[str] | None = None,
+    ) -> list[Path]:
+        """Posts matching every selector given; any one of ``tags`` will do."""
+        selected = []
+        for post, row in self.rows(posts).items():
+            if changed_since is not None and row["changed"] < changed_since:
+                continue
+            if stale and row["published_hash"] == row["content_hash"]:
+                continue
+            if tags and not set(tags) & set(json.loads(row["tags"])):
+                continue
+            selected.append(post)
+        return selected
+
+    def record(self, post: Path, digest: str, outputs: dict[str, str], published: bool) -> None:
+        """Note a successful prep of the content with hash ``digest``."""
+        self.refresh([post])
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                """UPDATE posts SET prepped = ?, prepped_hash = ?, outputs = ?,
+                       published = CASE WHEN ? THEN ? ELSE published END,
+                       published_hash = CASE WHEN ? THEN ? ELSE published_hash END
+                   WHERE path = ?""",
+                (now, digest, json.dumps(outputs, sort_keys=True),
+                 published, now, published, digest, catalog_key(post)),
+            )
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def print_catalog(rows: dict[Path, dict]) -> None:
+    """One line per post: when it changed, when it was last published, and its tags."""
+    day = lambda ts: time.strftime("%Y-%m-%d", time.localtime(ts)) if ts else "never"  # noqa: E731
+    width = max([len(row["path"]) for row in rows.values()] + [4])
+    print(f"{'post':<{width}} {'changed':<10} {'published':<10} {'stale':<5}  tags")
+    for row in rows.values():
+        stale = row["published_hash"] != row["content_hash"]
+        print(f"{row['path']:<{width}} {day(row['changed']):<10} {day(row['published']):<10} "
+              f"{'yes' if stale else '':<5}  {', '.join(json.loads(row['tags']))}")
+
+
+# ---------------------------------------------------------------------------
+# Export bundle
+# ---------------------------------------------------------------------------
+
+IMG_SRC = re.compile(r'(<img\b[^>]*?\ssrc=")([^"]*)(")')
+# Already-compressed formats are stored as-is rather than deflated again
+STORED_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif"}
+
+
+def post_image_sources(post: Path, body: str, index: ImageIndex) -> dict[str, Path]:
+    """Map the site URLs a post's shortcode images resolve to back to local files.
+
+    Covers the computed eleventy-img URLs and, when the site has been
+    built, the rendered ones under ``_site``.
+    """
+    sources: dict[str, Path] = {}
+    site_dir = index.site_dir
+    for m in IMAGE_SHORTCODE.finditer(body):
+        source = post.parent / m.group(1).strip().strip("\"'")
+        widths = image_widths(m)
+        predicted = widths and source.is_file() and index.predicted_urls(source, widths)
+        if predicted:
+            sources[f"{SITE_URL}{list(predicted.values())[-1]}"] = source
+    for img in index.page_images(site_dir / "blog" / post.parent.name / "index.html"):
+        built = site_dir / img["src"].lstrip("/")
+        if img["src"].startswith("/") and built.is_file():
+            sources[f"{SITE_URL}{img['src']}"] = built
+    return sources
+
+
+def local_image(src: str, post: Path, sources: dict[str, Path]) -> Path | None:
+    """The local file an <img> src points at: a file:// URI, a path relative
+    to the post, or a site URL built from a local image. None for the rest."""
+    from urllib.parse import unquote, urlsplit
+
+    src = html.unescape(src)
+    if src in sources:
+        return sources[src]
+    parts = urlsplit(src)
+    if parts.scheme == "file":
+        from urllib.request import url2pathname
+
+        path = Path(url2pathname(parts.path))
+    elif not parts.scheme and not parts.netloc and parts.path and not parts.path.startswith("/"):
+        path = post.parent / unquote(parts.path)
+    else:
+        return None
+    return path if path.is_file() else None
+
+
+class ExportBundle:
+    """One Substack import archive for many posts, written as each finishes.
+
+    Laid out like Substack's own export: ``posts.csv`` with each post's
+    id, date, title, subtitle and tags, ``posts/<id>.html``, and
+    ``images/`` with every local image the posts reference, named by
+    content hash so an image shared by several posts is stored once.
+    Entries are streamed into the zip one at a time, so memory is bounded
+    by the largest post, not the number of posts. The archive is written
+    to a temporary file and moved into place by ``close``.
+
+    With ``variants``, each image is stored as its Substack-sized variant
+    when that is smaller.
+    """
+
+    def __init__(self, path: Path, variants: ImageVariants | None = None) -> None:
+        import zipfile
+
+        self.path = path
+        self.variants = variants
+        self.tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        self.zip = zipfile.ZipFile(self.tmp, "w", zipfile.ZIP_DEFLATED)
+        self.rows: list[list[str]] = []
+        self.images: dict[str, str] = {}  # content hash -> archive name
+        self.files: dict[tuple, str] = {}  # (path, mtime_ns, size) -> archive name
+        self.indexes: dict[Path, ImageIndex] = {}
+        self.duplicates = 0
+        self.image_bytes = 0
+
+    def entry(self, name: str) -> BinaryIO:
+        """Open a new archive member for streaming writes."""
+        import zipfile
+
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        stored = Path(name).suffix.lower() in STORED_SUFFIXES
+        info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+        return self.zip.open(info, "w")
+
+    def add_post(self, post: Path, html_path: Path) -> None:
+        """Add a post's rendered HTML, rewriting local image sources into the bundle."""
+        fm, body = strip_frontmatter(post.read_text())
+        root = find_project_root(post.resolve())
+        index = self.indexes.setdefault(root, ImageIndex(root))
+        sources = post_image_sources(post, body, index)
+        page = html_path.read_text()
+        smaller: dict[Path, Path] = {}
+        if self.variants:
+            local = {local_image(m.group(2), post, sources) for m in IMG_SRC.finditer(page)}
+            smaller = self.variants.optimize([p for p in local if p], root)
+
+        def bundled(m: re.Match) -> str:
+            path = local_image(m.group(2), post, sources)
+            if path:
+                path = smaller.get(path, path)
+            return f"{m.group(1)}../{self.add_image(path)}{m.group(3)}" if path else m.group(0)
+
+        taken = {row[0] for row in self.rows}
+        post_id, n = post.stem, 1
+        while post_id in taken:
+            n += 1
+            post_id = f"{post.stem}-{n}"
+        page = IMG_SRC.sub(bundled, page)
+        with self.entry(f"posts/{post_id}.html") as out:
+            out.write(page.encode("utf-8"))
+        self.rows.append([
+            post_id,
+            str(fm["date"]) if fm.get("date") else "",
+            str(fm.get("title", post.stem)),
+            str(fm.get("description") or ""),
+            ",".join(frontmatter_tags(fm)),
+        ])
+
+    def add_image(self, path: Path) -> str:
+        """Store an image once per distinct content. Returns its archive name."""
+        stat = path.stat()
+        file_key = (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+        if file_key in self.files:
+            self.duplicates += 1
+            return self.files[file_key]
+        with path.open("rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        name = self.images.get(digest)
+        if name:
+            self.duplicates += 1
+        else:
+            name = f"images/{digest[:16]}{path.suffix.lower()}"
+            with path.open("rb") as src, self.entry(name) as out:
+                shutil.copyfileobj(src, out, CHUNK_SIZE)
+            self.images[digest] = name
+            self.image_bytes += stat.st_size
+        self.files[file_key] = name
+        return name
+
+    def close(self) -> None:
+        """Write posts.csv and move the finished archive into place."""
+        with self.entry("posts.csv") as out, io.TextIOWrapper(out, "utf-8", newline="") as text:
+            writer = csv.writer(text)
+            writer.writerow(["post_id", "post_date", "title", "subtitle", "tags"])
+            writer.writerows(self.rows)
+        self.zip.close()
+        for index in self.indexes.values():
+            index.save()
+        self.tmp.replace(self.path)
+
+    def abort(self) -> None:
+        self.zip.close()
+        self.tmp.unlink(missing_ok=True)
+
+
+# ---------------------------------------------------------------------------
+# Output sinks
+# ---------------------------------------------------------------------------
+
+# --sink values; "dir" takes a path, as in dir:out/
+SINK_NAMES = ("file", "dir", "stdout", "clipboard")
+
+
+def text_chunks(text: str, size: int = CHUNK_SIZE) -> Iterator[str]:
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+def write_atomic(path: Path, chunks: Iterable[str]) -> bool:
+    """Write chunks to path through a temporary file. Returns True if written.
+
+    The existing file is compared as the chunks arrive and left untouched
+    (mtime included) when the content is the same.
+    """
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        old = path.open(encoding="utf-8", errors="replace", newline="") if path.exists() else None
+    except OSError:
+        old = None
+    same = old is not None
+    try:
+        with tmp.open("w", encoding="utf-8", newline="") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                same = same and old.read(len(chunk)) == chunk
+        same = same and old.read(1) == ""
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    finally:
+        if old is not None:
+            old.close()
+    if same:
+        tmp.unlink()
+        return False
+    tmp.replace(path)
+    return True
+
+
+def pipe_chunks(cmd: list[str], chunks: Iterable[bytes]) -> None:
+    """Stream chunks to a command's stdin, never its argv."""
+    # stdout/stderr aren't piped: xclip and wl-copy fork a child that keeps
+    # serving the selection, and would hold the pipes open
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL) as proc:
+        try:
+            for chunk in chunks:
+                proc.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        finally:
+            proc.stdin.close()
+    if proc.returncode:
+        raise RuntimeError(f"{cmd[0]} exited with status {proc.returncode}")
+
+
+def copy_html_macos(chunks: Iterable[str]) -> None:
+    """Set the macOS clipboard to rich HTML via AppleScript's «data HTML<hex>».
+
+    The hex is encoded here and the script is read by osascript from stdin.
+    """
+    def script() -> Iterator[bytes]:
+        yield "set the clipboard to «data HTML".encode("utf-8")
+        for chunk in chunks:
+            yield chunk.encode("utf-8").hex().upper().encode("ascii")
+        yield "»".encode("utf-8")
+
+    pipe_chunks(["osascript", "-"], script())
+
+
+def copy_html_linux(chunks: Iterable[str]) -> None:
+    """Set the clipboard to rich HTML with wl-copy (Wayland) or xclip (X11)."""
+    if os.environ.get("WAYLAND_DISPLAY") and shutil.which("wl-copy"):
+        cmd = ["wl-copy", "--type", "text/html"]
+    elif shutil.which("xclip"):
+        cmd = ["xclip", "-selection", "clipboard", "-t", "text/html"]
+    else:
+        raise RuntimeError("no clipboard tool found (install wl-clipboard or xclip)")
+    pipe_chunks(cmd, (chunk.encode("utf-8") for chunk in chunks))
+
+
+# Rich-text clipboard backends by sys.platform: (HTML chunks) -> None.
+# Add an entry to support another platform.
+CLIPBOARD_BACKENDS: dict[str, Callable[[Iterable[str]], None]] = {
+    "darwin": copy_html_macos,
+    "linux": copy_html_linux,
+}
+
+
+class OutputSink:
+    """Somewhere rendered posts go. ``write`` gets one format's text in chunks."""
+
+    def formats(self, rendered: dict[str, str]) -> list[str]:
+        """Which of the rendered formats this sink takes."""
+        return list(rendered)
+
+    def write(self, post: Path, kind: str, chunks: Iterable[str]) -> Path | None:
+        """Send one format ("md" or "html"). Returns the file rewritten, if any."""
+        raise NotImplementedError
+
+
+class FileSink(OutputSink):
+    """Files next to the post (or at --output), skipped when unchanged."""
+
+    def __init__(self, output: Path | None = None) -> None:
+        self.output = output
+
+    def path(self, post: Path, kind: str) -> Path:
+        return dict(zip(("md", "html"), output_paths(post, self.output)))[kind]
+
+    def write(self, post: Path, kind: str, chunks: Iterable[str]) -> Path | None:
+        path = self.path(post, kind)
+        return path if write_atomic(path, chunks) else None
+
+
+class DirSink(FileSink):
+    """Every post's files in one directory, named after the post."""
+
+    def __init__(self, directory: Path) -> None:
+        super().__init__()
+        self.directory = directory
+
+    def path(self, post: Path, kind: str) -> Path:
+        return self.directory / f"{post.stem}_substack.{kind}"
+
+    def write(self, post: Path, kind: str, chunks: Iterable[str]) -> Path | None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        return super().write(post, kind, chunks)
+
+
+class StdoutSink(OutputSink):
+    """The rendered text on standard output; progress goes to stderr instead.
+
+    One document per stream: markdown when it was rendered, else the HTML.
+    """
+
+    def __init__(self) -> None:
+        self.stream = sys.stdout
+
+    def formats(self, rendered: dict[str, str]) -> list[str]:
+        return ["md"] if "md" in rendered else list(rendered)
+
+    def write(self, post: Path, kind: str, chunks: Iterable[str]) -> None:
+        for chunk in chunks:
+            self.stream.write(chunk)
+        self.stream.flush()
+
+
+class ClipboardSink(OutputSink):
+    """The post on the clipboard: HTML as rich text for pasting into Substack,
+    or markdown as plain text when that is all there is."""
+
+    def formats(self, rendered: dict[str, str]) -> list[str]:
+        return ["html"] if "html" in rendered else list(rendered)
+
+    def write(self, post: Path, kind: str, chunks: Iterable[str]) -> None:
+        if kind == "md":
+            import pyperclip
+
+            pyperclip.copy("".join(chunks))
+            return
+        backend = CLIPBOARD_BACKENDS.get(sys.platform)
+        if backend is None:
+            raise RuntimeError(f"no rich-text clipboard backend for {sys.platform}")
+        backend(chunks)
+
+
+def sink_spec(value: str) -> str:
+    """Validate a --sink value."""
+    name, sep, arg = value.partition(":")
+    if name not in SINK_NAMES or (name == "dir") != bool(sep and arg):
+        raise argparse.ArgumentTypeError(f"expected one of file, dir:PATH, stdout, clipboard (got {value!r})")
+    return value
+
+
+def make_sinks(specs: list[str], output: Path | None = None) -> list[OutputSink]:
+    """Sinks for --sink values; ``output`` is the file sink's --output path."""
+    sinks: list[OutputSink] = []
+    for spec in specs:
+        name, _, arg = spec.partition(":")
+        if name == "file":
+            sinks.append(FileSink(output))
+        elif name == "dir":
+            sinks.append(DirSink(Path(arg)))
+        elif name == "stdout":
+            sinks.append(StdoutSink())
+        else:
+            sinks.append(ClipboardSink())
+    return sinks
+
+
+def write_outputs(post: Path, rendered: dict[str, str], sinks: Sequence[OutputSink]) -> list[Path]:
+    """Send rendered formats to each sink. Returns the files rewritten."""
+    written = []
+    for sink in sinks:
+        for kind in sink.formats(rendered):
+            path = sink.write(post, kind, text_chunks(rendered[kind]))
+            if path:
+                written.append(path)
+    return written
+
+
+# ---------------------------------------------------------------------------
+# Entrypoint
+# ---------------------------------------------------------------------------
+
+def render_formats(doc: Document, fmt: str, memo: StageCache | None = None) -> dict[str, str]:
+    """Render doc in the formats fmt asks for, keyed "md" and "html"."""
+    rendered = {}
+    if fmt in ("md", "both"):
+        rendered["md"] = memo.get("md", (doc.body, doc.notes, doc.atoms), doc.markdown) if memo else doc.markdown()
+    if fmt in ("html", "both"):
+        rendered["html"] = memo.get("html", (doc.body, doc.notes, doc.atoms), doc.html) if memo else doc.html()
+    return rendered
+
+
+def watch_stamp(post: Path) -> tuple:
+    """Modification stamps of everything a post's output depends on."""
+    try:
+        text = post.read_text()
+    except OSError:
+        return (None,)
+    return (file_stamp(post), image_inputs(strip_frontmatter(text)[1], post))
+
+
+def watch_post(
+    post: Path,
+    dry_run: bool,
+    sinks: Sequence[OutputSink] | None = None,
+    concurrency: int = DW_CONCURRENCY,
+    math: MathImages | None = None,
+    fmt: str = "both",
+    interval: float = 0.3,
+) -> None:
+    """Rebuild a post whenever it, its images or its rendered page change."""
+    sinks = sinks or [FileSink()]
+    memo = StageCache()
+    last = None
+    print(f"Watching {post} (Ctrl-C to stop)...")
+    try:
+        while True:
+            stamp = watch_stamp(post)
+            if stamp != last:
+                last = stamp
+                t0 = time.perf_counter()
+                hits, misses = memo.hits, memo.misses
+                try:
+                    with contextlib.redirect_stdout(io.StringIO()) as log:
+                        doc = transform(post.read_text(), post, dry_run, concurrency, memo, None, math)
+                        rendered = render_formats(doc, fmt, memo)
+                    written = [p.name for p in write_outputs(post, rendered, sinks)]
+                    cached, stages = memo.hits - hits, memo.hits - hits + memo.misses - misses
+                    # Only show stage output (warnings, uploads) when stages re-ran
+                    if cached < stages:
+                        print(log.getvalue().rstrip())
+                    ms = (time.perf_counter() - t0) * 1000
+                    print(f"[{time.strftime('%H:%M:%S')}] rebuilt in {ms:.0f} ms, "
+                          f"{cached}/{stages} stages cached, "
+                          f"{'wrote ' + ', '.join(written) if written else 'outputs unchanged'}")
+                except Exception as e:
+                    print(f"[{time.strftime('%H:%M:%S')}] ✗ {type(e).__name__}: {e}")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+
+
+def serve_prep(session: PrepSession, request: dict) -> dict:
+    """Handle one /prep request: transform a post and return md, html and a report.
+
+    Only posts under BLOG_DIR are served, and outputs are only ever written
+    next to the post.
+    """
+    post = Path(request["post"]).resolve()
+    if post.suffix != ".md" or not post.is_relative_to(BLOG_DIR):
+        raise PermissionError(f"not a post under {BLOG_DIR}: {request['post']}")
+    if "output" in request:
+        raise ValueError("output is not supported; outputs are written next to the post")
+    dry_run = bool(request.get("dry_run", False))
+    fmt = request.get("format", "both")
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(OUTPUT_FORMATS)}")
+    math = MathImages(fmt=request["render_math"]) if request.get("render_math") else None
+    if math and math.fmt not in MATH_FORMATS:
+        raise ValueError(f"render_math must be one of {', '.join(MATH_FORMATS)}")
+    if request.get("optimize_images"):
+        raise ValueError("optimize_images only applies to --export")
+    memo = session.memo(post)
+    log = io.StringIO()
+    t0 = time.perf_counter()
+    with session.lock, contextlib.redirect_stdout(log):
+        text = post.read_text()
+        report: dict = count_elements(strip_frontmatter(text)[1])
+        hits = memo.hits
+        doc = transform(text, post, dry_run, session.concurrency, memo, session, math)
+        rendered = render_formats(doc, fmt, memo)
+        report["stages_cached"] = memo.hits - hits
+        if request.get("write"):
+            report["written"] = [str(p) for p in write_outputs(post, rendered, [FileSink()])]
+    report["seconds"] = round(time.perf_counter() - t0, 3)
+    report["log"] = log.getvalue()
+    return {"post": str(post), "markdown": rendered.get("md"), "html": rendered.get("html"), "report": report}
+
+
+def serve(address: str, concurrency: int = DW_CONCURRENCY) -> None:
+    """Serve preps over a local HTTP/JSON API until interrupted.
+
+    ``address`` is ``host:port``, a bare port, or a Unix socket path.
+    Endpoints: ``POST /prep`` with ``{"post", "dry_run", "format", "write",
+    "render_math"}``,
+    ``GET /metrics`` and ``GET /health``. Preps run one at a time; tables
+    within a prep are still uploaded concurrently.
+
+    ``/prep`` only takes ``application/json`` without an ``Origin`` header,
+    so a web page can't drive it from the browser: cross-origin pages can
+    only send simple requests, and any fetch from a page carries an Origin.
+    """
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    # Pay for the heavy imports once, up front
+    import lxml.etree  # noqa: F401
+    import yaml  # noqa: F401
+
+    session = PrepSession(concurrency)
+    started = time.time()
+    stats_lock = threading.Lock()
+    requests = {"ok": 0, "error": 0}
+    latencies: list[float] = []
+
+    def metrics() -> dict:
+        with stats_lock:
+            times = sorted(latencies)
+            counts = dict(requests)
+        memos = session.memos.values()
+        return {
+            "uptime_seconds": round(time.time() - started, 1),
+            "requests": counts,
+            "latency_ms": {
+                "p50": round(times[len(times) // 2] * 1000, 1),
+                "p95": round(times[int(len(times) * 0.95)] * 1000, 1),
+                "max": round(times[-1] * 1000, 1),
+            } if times else {},
+            "stage_cache": {
+                "hits": sum(m.hits for m in memos),
+                "misses": sum(m.misses for m in memos),
+            },
+            "datawrapper": {
+                "retries": session.dw_client.retries,
+                "endpoints": session.dw_client.stats(),
+            } if session.dw_client else {},
+        }
+
+    class Handler(BaseHTTPRequestHandler):
+        def address_string(self) -> str:
+            # Unix socket peers have no (host, port)
+            return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+        def reply(self, status: int, body: dict) -> None:
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            if self.path == "/health":
+                self.reply(200, {"ok": True})
+            elif self.path == "/metrics":
+                self.reply(200, metrics())
+            else:
+                self.reply(404, {"error": f"no such endpoint: {self.path}"})
+
+        def do_POST(self) -> None:
+            if self.path != "/prep":
+                self.reply(404, {"error": f"no such endpoint: {self.path}"})
+                return
+            if "Origin" in self.headers:
+                self.reply(403, {"error": "requests from web pages are not accepted"})
+                return
+            if self.headers.get_content_type() != "application/json":
+                self.reply(415, {"error": "Content-Type must be application/json"})
+                return
+            t0 = time.perf_counter()
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                status, body = 200, serve_prep(session, json.loads(self.rfile.read(length)))
+            except (KeyError, TypeError, ValueError) as e:
+                status, body = 400, {"error": f"bad request: {type(e).__name__}: {e}"}
+            except FileNotFoundError as e:
+                status, body = 404, {"error": str(e)}
+            except PermissionError as e:
+                status, body = 403, {"error": str(e)}
+            except Exception as e:
+                status, body = 500, {"error": f"{type(e).__name__}: {e}"}
+            with stats_lock:
+                requests["ok" if status == 200 else "error"] += 1
+                latencies.append(time.perf_counter() - t0)
+            self.reply(status, body)
+
+    unix = "/" in address
+    if unix:
+        class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        Path(address).unlink(missing_ok=True)
+        server = UnixHTTPServer(address, Handler)
+    else:
+        host, _, port = address.rpartition(":")
+        server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+    print(f"Serving on {address if unix else 'http://%s:%d' % server.server_address[:2]} (Ctrl-C to stop)...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped serving.")
+    finally:
+        server.server_close()
+        session.close()
+        if unix:
+            Path(address).unlink(missing_ok=True)
+
+
+def output_paths(post: Path, output: Path | None = None) -> tuple[Path, Path]:
+    """Return the (markdown, html) output paths for a post."""
+    out_path = output or post.with_name(post.stem + "_substack.md")
+    return out_path, out_path.with_suffix(".html")
+
+
+def count_elements(body: str) -> dict[str, int]:
+    """Count tables and image shortcodes in a post body (for batch reports)."""
+    return {
+        "tables": len(find_html_tables(body)) + len(find_markdown_tables(body)),
+        "images": len(IMAGE_SHORTCODE.findall(body)),
+    }
+
+
+def prep_post(
+    post: Path,
+    dry_run: bool,
+    sinks: Sequence[OutputSink] | None = None,
+    concurrency: int = DW_CONCURRENCY,
+    math: MathImages | None = None,
+    fmt: str = "both",
+) -> dict:
+    """Transform one post and write its outputs. Returns a manifest entry.
+
+    Never raises: failures are recorded in the entry so a batch keeps going.
+    The entry names the files written by the first file or dir sink.
+    """
+    sinks = sinks or [FileSink()]
+    entry: dict = {"post": str(post), "status": "ok"}
+    log = io.StringIO()
+    t0 = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(log):
+            text = post.read_text()
+            entry.update(count_elements(strip_frontmatter(text)[1]))
+            memo = StageCache()
+            doc = transform(text, post, dry_run, concurrency, memo, math=math)
+            rendered = render_formats(doc, fmt, memo)
+            write_outputs(post, rendered, sinks)
+        entry["content_hash"] = content_hash(text)
+        entry["outputs"] = memo.digests()
+        # Published only if every table made it to Datawrapper
+        entry["published"] = not dry_run and not doc.tables_left
+        files = next((sink for sink in sinks if isinstance(sink, FileSink)), None)
+        if files and "md" in rendered:
+            entry["markdown"] = str(files.path(post, "md"))
+        if files and "html" in rendered:
+            entry["html"] = str(files.path(post, "html"))
+    except Exception as e:
+        entry["status"] = "error"
+        entry["error"] = f"{type(e).__name__}: {e}"
+    entry["seconds"] = round(time.perf_counter() - t0, 3)
+    entry["log"] = log.getvalue()
+    return entry
+
+
+def run_batch(
+    posts: list[Path],
+    dry_run: bool,
+    jobs: int,
+    manifest: Path,
+    concurrency: int = DW_CONCURRENCY,
+    math: MathImages | None = None,
+    fmt: str = "both",
+    catalog: PostCatalog | None = None,
+    bundle: ExportBundle | None = None,
+    sinks: Sequence[OutputSink] | None = None,
+) -> int:
+    """Convert many posts in a process pool and write a summary manifest.
+
+    Successful preps are recorded in ``catalog`` and added to ``bundle``,
+    if given, as they finish.
+    """
+    from concurrent.futures import as_completed
+
+    print(f"Converting {len(posts)} posts with {jobs} workers...")
+    t0 = time.perf_counter()
+    entries: list[dict] = []
+    with process_pool(max(1, jobs)) as pool:
+        futures = {pool.submit(prep_post, p, dry_run, sinks, concurrency, math, fmt): p for p in posts}
+        for fut in as_completed(futures):
+            entry = fut.result()
+            entries.append(entry)
+            if bundle and entry["status"] == "ok":
+                try:
+                    bundle.add_post(futures[fut], Path(entry["html"]))
+                except Exception as e:
+                    entry["status"] = "error"
+                    entry["error"] = f"export failed: {type(e).__name__}: {e}"
+            if catalog and entry["status"] == "ok":
+                catalog.record(futures[fut], entry["content_hash"], entry["outputs"], entry["published"])
+            mark = "✓" if entry["status"] == "ok" else "✗"
+            detail = entry.get("error") or f"{entry['tables']} tables, {entry['images']} images"
+            print(f"  {mark} {entry['post']} ({entry['seconds']:.2f}s) — {detail}")
+
+    entries.sort(key=lambda e: e["post"])
+    failed = sum(e["status"] != "ok" for e in entries)
+    manifest.write_text(json.dumps({
+        "dry_run": dry_run,
+        "jobs": jobs,
+        "seconds": round(time.perf_counter() - t0, 3),
+        "ok": len(entries) - failed,
+        "failed": failed,
+        "posts": entries,
+    }, indent=2))
+    print(f"\n{len(entries) - failed} ok, {failed} failed. Manifest written to: {manifest}")
+    return 1 if failed else 0
+
+
+def finish_trace(profile: bool, trace_json: Path | None) -> None:
+    """Print and/or write what the tracer collected."""
+    if TRACER is None:
+        return
+    if profile:
+        TRACER.print_summary()
+    if trace_json:
+        TRACER.write(trace_json)
+        print(f"Trace written to: {trace_json}")
+
+
+def main() -> None:
+    args = parse_args()
+    posts = discover_posts(args.posts, args.all)
+
+    if args.serve is not None:
+        serve(args.serve, args.concurrency)
+        return
+
+    if args.gc_orphans:
+        token = datawrapper_token()
+        if not token:
+            print("ERROR: DATAWRAPPER_TOKEN not found in .env", file=sys.stderr)
+            sys.exit(1)
+        cache, dw_client = ChartCache(), DatawrapperClient(token)
+        try:
+            gc_orphans(cache, dw_client, delete=args.gc_orphans == "delete")
+        finally:
+            dw_client.close()
+            cache.close()
+        return
+
+    if args.migrate_cache or args.evict_older_than is not None or args.evict_unused is not None:
+        cache = ChartCache()
+        if args.migrate_cache:
+            # Without explicit posts, migrate every post that has a legacy cache
+            imported = migrate_legacy_caches(posts or discover_posts([], True), cache)
+            print(f"Imported {imported} charts into {CHART_CACHE_DB}")
+        if args.evict_older_than is not None or args.evict_unused is not None:
+            removed = cache.evict(args.evict_older_than, args.evict_unused)
+            print(f"Evicted {removed} chart cache entries")
+        cache.close()
+        if not args.posts and not args.all and not args.selecting:
+            return
+
+    catalog = PostCatalog()
+    if args.selecting:
+        every = discover_posts([], True)
+        catalog.refresh(sorted(set(every) | set(posts)))
+        posts = catalog.select(posts or every, args.changed_since, args.stale, args.tag)
+        if args.list:
+            print_catalog(catalog.rows(posts))
+            catalog.close()
+            return
+        print(f"Selected {len(posts)} of {len(every)} posts.")
+        if not posts:
+            catalog.close()
+            return
+
+    if args.batch or len(posts) > 1:
+        manifest = args.manifest or Path("substack_manifest.json")
+        # Posts already run in parallel, so each renders its formulas serially
+        math = MathImages(args.math_renderer, args.render_math, jobs=1) if args.render_math else None
+        variants = ImageVariants(args.max_image_width) if args.optimize_images else None
+        bundle = ExportBundle(args.export, variants) if args.export else None
+        try:
+            code = run_batch(posts, args.dry_run, args.jobs, manifest, args.concurrency, math,
+                             args.format, catalog, bundle, make_sinks(args.sink))
+        except BaseException:
+            if bundle:
+                bundle.abort()
+            raise
+        finally:
+            catalog.close()
+        if bundle:
+            bundle.close()
+            print(f"Export bundle written to: {args.export} — {len(bundle.rows)} posts, "
+                  f"{len(bundle.images)} distinct images ({format_bytes(bundle.image_bytes)}), "
+                  f"{bundle.duplicates} repeated image references deduplicated")
+        sys.exit(code)
+
+    if not posts or not posts[0].exists():
+        print(f"Error: {args.posts[0]} not found.", file=sys.stderr)
+        sys.exit(1)
+    post = posts[0]
+    math = MathImages(args.math_renderer, args.render_math) if args.render_math else None
+    if args.profile or args.trace_json:
+        global TRACER
+        TRACER = Tracer()
+
+    if args.watch:
+        catalog.close()
+        watch_post(post, args.dry_run, make_sinks(args.sink, args.output), args.concurrency, math, args.format)
+        finish_trace(args.profile, args.trace_json)
+        return
+
+    sinks = make_sinks(args.sink, args.output)
+    if any(isinstance(sink, StdoutSink) for sink in sinks):
+        # Standard output carries the post itself; progress goes to stderr
+        sys.stdout = sys.stderr
+    text = post.read_text()
+    memo = StageCache()
+    with trace("prep", "total") as span:
+        try:
+            doc = transform(text, post, args.dry_run, args.concurrency, memo, math=math)
+        except TableTooLarge as e:
+            catalog.close()
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        rendered = render_formats(doc, args.format, memo)
+        if TRACER is not None:
+            span.update(input_bytes=utf8_len(text), output_bytes=utf8_len(doc.body))
+
+    # Files and stdout first; the clipboard last, so a failed copy still leaves the files
+    clipboard = [sink for sink in sinks if isinstance(sink, ClipboardSink)]
+    files = [sink for sink in sinks if isinstance(sink, FileSink)]
+    write_outputs(post, rendered, [sink for sink in sinks if sink not in clipboard])
+    # A run that left tables in place for lack of a token isn't a publish
+    catalog.record(post, content_hash(text), memo.digests(), not args.dry_run and not doc.tables_left)
+    catalog.close()
+    print()
+    for sink in files:
+        if "md" in rendered:
+            print(f"Markdown written to: {sink.path(post, 'md')}")
+        if "html" in rendered:
+            print(f"HTML written to: {sink.path(post, 'html')}")
+    finish_trace(args.profile, args.trace_json)
+
+    for sink in clipboard:
+        try:
+            write_outputs(post, rendered, [sink])
+            if "html" in rendered:
+                print("Rich text copied to clipboard — paste directly into Substack.")
+            else:
+                print("Markdown copied to clipboard.")
         except Exception as e:
             print(f"Could not copy to clipboard: {e}")
-            print("Open the HTML file manually and copy from there.")
+            if files and "html" in rendered:
+                print("Open the HTML file manually and copy from there.")
 
-    if args.open:
-        webbrowser.open(f"file://{html_path.resolve()}")
+    if args.open and files and "html" in rendered:
+        webbrowser.open(f"file://{files[0].path(post, 'html').resolve()}")
 
 
 if __name__ == "__main__":
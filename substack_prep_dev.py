@@ -0,0 +1,743 @@
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#     "httpx",
+#     "pyyaml",
+#     "python-dotenv",
+#     "pyperclip",
+#     "lxml",
+# ]
+# ///
+"""Development tools for substack_prep.py.
+
+A local Datawrapper stand-in and load test, the per-stage benchmark, the
+startup-budget check and the golden-output check. None of this ships in the prep script itself, so it
+never adds to the script's own import time.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import py_compile
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable
+
+from substack_prep import (
+    DW_CONCURRENCY,
+    PROJECT_ROOT,
+    Document,
+    DocumentIndex,
+    Renderer,
+    collect_tables,
+    count_elements,
+    discover_posts,
+    embed_url_for,
+    find_html_tables,
+    find_markdown_tables,
+    format_bytes,
+    plan_tables,
+    resolve_image_urls,
+    scan_body,
+    strip_frontmatter,
+    transform,
+    utf8_len,
+)
+
+SCRIPT = PROJECT_ROOT / "substack_prep.py"
+BENCH_BASELINE = PROJECT_ROOT / "substack_bench.json"
+# Timing differences below this many ms are noise, whatever the ratio
+BENCH_NOISE_MS = 0.5
+
+
+# ---------------------------------------------------------------------------
+# Local Datawrapper stand-in
+# ---------------------------------------------------------------------------
+
+FAKE_DW_ROUTE = re.compile(r"^/v3/charts(?:/([^/?]+))?(?:/(data|publish))?/?(?:\?(.*))?$")
+
+
+class FakeDatawrapper:
+    """In-memory stand-in for the Datawrapper endpoints DatawrapperClient uses.
+
+    Every response is delayed by ``latency_ms`` (±50%), and a fraction of
+    requests fail with 429 (``Retry-After: 0``) or 503 before being handled,
+    so retries, concurrency and caching can be exercised without a network.
+    """
+
+    def __init__(
+        self,
+        latency_ms: float = 50.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        seed: int | None = None,
+    ) -> None:
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rng = random.Random(seed)
+        self.charts: dict[str, dict] = {}
+        self.calls: dict[str, int] = defaultdict(int)
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def handle(self, method: str, path: str, authorized: bool, body: bytes) -> tuple[int, dict | None]:
+        """Route one request. Returns (status, JSON body or None)."""
+        m = FAKE_DW_ROUTE.match(path)
+        chart_id, action = (m.group(1), m.group(2)) if m else (None, None)
+        endpoint = f"{method} /charts" + ("/{id}" if chart_id else "") + (f"/{action}" if action else "")
+        time.sleep(self.latency * (0.5 + self.rng.random()))
+        with self.lock:
+            roll = self.rng.random()
+            if not m:
+                status, reply = 404, {"message": "Not found"}
+            elif not authorized:
+                status, reply = 401, {"message": "Unauthorized"}
+            elif roll < self.rate_limit_rate:
+                status, reply = 429, {"message": "Too many requests"}
+            elif roll < self.rate_limit_rate + self.error_rate:
+                status, reply = 503, {"message": "Service unavailable"}
+            else:
+                status, reply = self.route(method, chart_id, action, body, m.group(3) or "")
+            self.calls[f"{endpoint} {status}"] += 1
+        return status, reply
+
+    def route(self, method: str, chart_id: str | None, action: str | None, body: bytes, query: str) -> tuple[int, dict | None]:
+        if chart_id is None:
+            if method == "POST":
+                self.next_id += 1
+                chart_id = f"fk{self.next_id:03d}"
+                meta = json.loads(body or b"{}")
+                self.charts[chart_id] = {"id": chart_id, "title": meta.get("title", ""),
+                                         "type": meta.get("type"), "publicVersion": 0}
+                return 201, self.charts[chart_id]
+            if method == "GET":
+                params = dict(p.split("=", 1) for p in query.split("&") if "=" in p)
+                offset, limit = int(params.get("offset", 0)), int(params.get("limit", 100))
+                charts = list(self.charts.values())
+                return 200, {"list": charts[offset:offset + limit], "total": len(charts)}
+            return 405, {"message": "Method not allowed"}
+        chart = self.charts.get(chart_id)
+        if chart is None:
+            return 404, {"message": f"Chart {chart_id} not found"}
+        if action == "data" and method == "PUT":
+            chart["data"] = body.decode("utf-8")
+            return 204, None
+        if action == "publish" and method == "POST":
+            chart["publicVersion"] += 1
+            url = embed_url_for(chart_id, chart["publicVersion"])
+            chart["publicUrl"] = url
+            return 200, {"data": chart, "version": chart["publicVersion"], "url": url}
+        if action is None and method == "PATCH":
+            chart.setdefault("metadata", {}).update(json.loads(body or b"{}").get("metadata", {}))
+            return 200, chart
+        if action is None and method == "DELETE":
+            del self.charts[chart_id]
+            return 204, None
+        return 405, {"message": "Method not allowed"}
+
+    def start(self, address: str = "127.0.0.1:0") -> str:
+        """Serve in a background thread. Returns the API base URL."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def respond(self) -> None:
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                authorized = self.headers.get("Authorization", "").startswith("Bearer ")
+                status, reply = fake.handle(self.command, self.path, authorized, body)
+                data = json.dumps(reply).encode("utf-8") if reply is not None else b""
+                self.send_response(status)
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                if data:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = respond
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        host, _, port = address.rpartition(":")
+        self.server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return "http://%s:%d/v3" % self.server.server_address[:2]
+
+    def stop(self) -> None:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def snapshot(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.calls)
+
+
+def load_test(
+    posts: list[Path],
+    fake: FakeDatawrapper,
+    jobs: int,
+    concurrency: int = DW_CONCURRENCY,
+) -> int:
+    """Run posts singly and as batches against a fake Datawrapper; report throughput.
+
+    Posts are copied into a throwaway project with its own chart cache, and
+    each scenario runs the real CLI in a subprocess pointed at the fake.
+    Returns 1 if any run failed.
+    """
+    tables = sum(count_elements(strip_frontmatter(p.read_text())[1])["tables"] for p in posts)
+    script = str(SCRIPT)
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        (root / "eleventy.config.js").touch()
+        copies = []
+        for post in posts:
+            copy = root / "content" / "blog" / post.parent.name / post.name
+            copy.parent.mkdir(parents=True, exist_ok=True)
+            copy.write_text(post.read_text())
+            copies.append(str(copy))
+        env = {
+            **os.environ,
+            "DATAWRAPPER_API": fake.start(),
+            "DATAWRAPPER_TOKEN": "fake-token",
+            "SUBSTACK_CHART_CACHE": str(root / "charts.sqlite"),
+            "SUBSTACK_CATALOG": str(root / "catalog.sqlite"),
+        }
+        common = ["--no-copy", "--concurrency", str(concurrency)]
+        batch = [script, *copies, *common, "--jobs", str(jobs), "--manifest", str(root / "manifest.json")]
+        scenarios = [
+            ("single posts, cold cache", [[script, post, *common] for post in copies]),
+            ("batch, cold cache", [batch]),
+            ("batch, warm cache", [batch]),
+        ]
+        print(f"Load testing {len(posts)} posts ({tables} tables) against {env['DATAWRAPPER_API']} "
+              f"(latency {fake.latency * 1000:.0f} ms, {fake.error_rate:.0%} errors, "
+              f"{fake.rate_limit_rate:.0%} rate-limited)\n")
+        print(f"{'scenario':<26} {'seconds':>8} {'posts/s':>8} {'tables/s':>9} {'calls':>6} {'429':>5} {'5xx':>5}  result")
+        try:
+            for name, runs in scenarios:
+                if "cold" in name:
+                    for db in root.glob("charts.sqlite*"):
+                        db.unlink()
+                before = fake.snapshot()
+                t0 = time.perf_counter()
+                errors = sum(
+                    subprocess.run([sys.executable, *argv], env=env, cwd=PROJECT_ROOT,
+                                   capture_output=True).returncode != 0
+                    for argv in runs
+                )
+                seconds = time.perf_counter() - t0
+                calls = {k: v - before.get(k, 0) for k, v in fake.snapshot().items() if v != before.get(k, 0)}
+                failed += errors
+                count = lambda suffix: sum(v for k, v in calls.items() if k.endswith(suffix))  # noqa: E731
+                print(f"{name:<26} {seconds:>8.2f} {len(posts) / seconds:>8.1f} {tables / seconds:>9.1f} "
+                      f"{sum(calls.values()):>6} {count(' 429'):>5} {count(' 503'):>5}  "
+                      f"{'ok' if not errors else f'{errors} run(s) failed'}")
+        finally:
+            fake.stop()
+        print("\nCalls by endpoint and status (all scenarios):")
+        for key, n in sorted(fake.snapshot().items()):
+            print(f"  {key:<40} {n:>6}")
+    return 1 if failed else 0
+
+INTERRUPT_TABLE = "**Interrupt table {n}**\n\n| Case | Value |\n|---|---|\n| {n} | 1 |\n\n"
+
+
+def check_interrupt(tables: int = 12, latency_ms: float = 100.0, after: float = 1.5) -> int:
+    """Ctrl-C during uploads must cancel the queued ones. Returns an exit code.
+
+    Publishes a post with ``tables`` tables one at a time against a slow
+    fake Datawrapper, sends SIGINT ``after`` seconds in, and checks that
+    the run exits promptly without publishing the rest.
+    """
+    import signal
+
+    fake = FakeDatawrapper(latency_ms, seed=0)
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        (root / "eleventy.config.js").touch()
+        post = root / "content" / "blog" / "interrupt" / "interrupt.md"
+        post.parent.mkdir(parents=True)
+        body = "".join(INTERRUPT_TABLE.format(n=n) for n in range(tables))
+        post.write_text(f"---\ntitle: Interrupt\n---\n\n{body}")
+        env = {
+            **os.environ,
+            "DATAWRAPPER_API": fake.start(),
+            "DATAWRAPPER_TOKEN": "fake-token",
+            "SUBSTACK_CHART_CACHE": str(root / "charts.sqlite"),
+            "SUBSTACK_CATALOG": str(root / "catalog.sqlite"),
+        }
+        try:
+            proc = subprocess.Popen(
+                [sys.executable, str(SCRIPT), str(post), "--no-copy", "--concurrency", "1"],
+                env=env, cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            time.sleep(after)
+            proc.send_signal(signal.SIGINT)
+            t0 = time.perf_counter()
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            seconds = time.perf_counter() - t0
+        finally:
+            fake.stop()
+    published = sum(n for key, n in fake.snapshot().items() if key.startswith("POST /charts/{id}/publish"))
+    # In-flight steps may finish, so allow about one more chart's worth of calls
+    limit = 6 * latency_ms / 1000 + 1
+    ok = published < tables and seconds < limit
+    print(f"  {'✓' if ok else '✗'} SIGINT after {after:.1f}s: exited in {seconds:.2f}s "
+          f"(limit {limit:.1f}s), published {published} of {tables} charts")
+    return 0 if ok else 1
+
+
+# ---------------------------------------------------------------------------
+# Startup budget
+# ---------------------------------------------------------------------------
+
+# Startup budget: milliseconds spent importing modules (excluding the
+# interpreter's own site setup) for each common path, and modules that path
+# must never import. Enforced by --check-startup via `python -X importtime`.
+STARTUP_BUDGET = {
+    "import": (100, ("pandas", "httpx", "bs4", "lxml", "markdown", "yaml", "dotenv")),
+    "dry-run, no tables": (250, ("pandas", "httpx", "bs4", "dotenv")),
+    "dry-run, tables": (250, ("pandas", "httpx", "bs4", "dotenv")),
+}
+
+
+def measure_imports(argv: list[str]) -> tuple[float, set[str]]:
+    """Run ``python -X importtime`` on argv. Returns (import ms, modules imported)."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", *argv],
+        capture_output=True, text=True, cwd=PROJECT_ROOT,
+    )
+    total_us = 0
+    modules: set[str] = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        modules.add(name.strip())
+        # Top-level imports have no indentation; site setup is not ours
+        if not name.startswith("  ") and name.strip() not in ("site", "sitecustomize", "usercustomize"):
+            total_us += int(cumulative)
+    return total_us / 1000, modules
+
+
+def check_startup() -> int:
+    """Check the common paths against STARTUP_BUDGET. Returns an exit code."""
+    posts = discover_posts([], True)
+    table_counts = {p: count_elements(strip_frontmatter(p.read_text())[1])["tables"] for p in posts}
+    with_tables = next(p for p in posts if table_counts[p])
+    without_tables = next(p for p in posts if not table_counts[p])
+    script = str(SCRIPT)
+    # "import" times loading the module, not compiling it: byte-compile first,
+    # as the first import would, even under PYTHONDONTWRITEBYTECODE
+    py_compile.compile(script)
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        out = str(Path(tmp) / "out.md")
+        runs = {
+            "import": ["-c", "import substack_prep"],
+            "dry-run, no tables": [script, str(without_tables), "--dry-run", "--no-copy", "-o", out],
+            "dry-run, tables": [script, str(with_tables), "--dry-run", "--no-copy", "-o", out],
+        }
+        for name, argv in runs.items():
+            budget, forbidden = STARTUP_BUDGET[name]
+            ms, modules = measure_imports(argv)
+            loaded = [m for m in forbidden if m in modules]
+            ok = ms <= budget and not loaded
+            failed += not ok
+            note = f" — imported {', '.join(loaded)}" if loaded else ""
+            print(f"  {'✓' if ok else '✗'} {name:<20} {ms:7.1f} ms (budget {budget} ms){note}")
+    return 1 if failed else 0
+
+
+# ---------------------------------------------------------------------------
+# Stage benchmark
+# ---------------------------------------------------------------------------
+
+# One unit of a synthetic post: every construct the pipeline handles. {n}
+# keeps footnote names and table titles unique across repeated units.
+SYNTHETIC_UNIT = """\
+## Section {n}
+
+Prose with inline math $\\alpha_{n} + \\beta^2$, a price of $100, a note[^a{n}] and
+another[^b{n}], plus {{{{ page.url }}}} and {{% if draft %}}drafts{{% endif %}} noise.
+
+{{% image "figures/plot_{n}.png", "Plot {n}" %}}
+
+$$
+\\hat\\theta_{n} = \\frac{{1}}{{n}} \\sum_i x_i
+$$
+
+**Results for group {n}**
+
+| Model | Accuracy | Share |
+|---|---|---|
+| A{n} | 0.91 | 45% |
+| B{n} | 0.87 | 55% |
+| C{n} | 0.79 | 12% |
+
+<table><thead><tr><th>Year</th><th>Value</th></tr></thead>
+<tbody><tr><td>2023</td><td>{n}.5</td></tr><tr><td>2024</td><td>7.25</td></tr></tbody></table>
+
+<!-- draft comment {n} -->
+<div class="note">Stray <span>markup</span> {n}.</div>
+
+```python
+x = {n}  # $not math$ [^not_a_ref]
+```
+
+"""
+SYNTHETIC_NOTE = "[^a{n}]: First note for {n}, citing $x_{n}$.\n[^b{n}]: Second note for {n}.\n"
+
+
+def synthetic_post(units: int) -> str:
+    """A post with ``units`` copies of SYNTHETIC_UNIT and their footnotes."""
+    body = "".join(SYNTHETIC_UNIT.format(n=n) for n in range(units))
+    notes = "".join(SYNTHETIC_NOTE.format(n=n) for n in range(units))
+    return f"---\ntitle: Synthetic x{units}\n---\n\n{body}## Footnotes\n\n{notes}"
+
+
+def bench_stages(post_path: Path) -> dict[str, Callable[[str], object]]:
+    """Benchmarked stages, each a function of the post text.
+
+    These are the functions ``transform`` runs. Bodies, table spans and
+    the scanned Document are computed once per text, so each stage times
+    only its own work.
+    """
+    bodies: dict[str, tuple[str, list[tuple[int, int]]]] = {}
+    documents: dict[str, Document] = {}
+
+    def body(text: str) -> str:
+        if text not in bodies:
+            b = strip_frontmatter(text)[1]
+            bodies[text] = (b, sorted(find_html_tables(b) + find_markdown_tables(b)))
+        return bodies[text][0]
+
+    def scan(text: str) -> Renderer:
+        return scan_body(body(text), bodies[text][1], {}, {})
+
+    def collect(text: str) -> None:
+        for *_, table in collect_tables(body(text)):
+            if table is not None:
+                table.close()
+
+    def document(text: str) -> Document:
+        if text not in documents:
+            documents[text] = scan(text).document()
+        return documents[text]
+
+    return {
+        "strip_frontmatter": strip_frontmatter,
+        "find_markdown_tables": lambda text: find_markdown_tables(body(text)),
+        "find_html_tables": lambda text: find_html_tables(body(text)),
+        "document_index": lambda text: DocumentIndex(body(text)),
+        "collect_tables": collect,
+        "plan_tables (dry-run)": lambda text: plan_tables(body(text), "Bench", post_path, True),
+        "resolve_image_urls": lambda text: resolve_image_urls(post_path, body(text)),
+        "renderer_scan": lambda text: scan(text).document(),
+        "document_markdown": lambda text: document(text).markdown(),
+        "document_html": lambda text: document(text).html(),
+        "transform (dry-run)": lambda text: transform(text, post_path, True),
+    }
+
+
+def time_stage(fn: Callable[[str], object], text: str, budget: float = 0.2) -> float:
+    """Best-of-N wall time of fn(text) in ms, spending about ``budget`` seconds."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        fn(text)
+        best = time.perf_counter() - t0
+        for _ in range(min(20, int(budget / max(best, 1e-6)))):
+            t0 = time.perf_counter()
+            fn(text)
+            best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+
+def run_bench(
+    posts: list[Path],
+    scales: list[int],
+    baseline: Path,
+    update: bool,
+    threshold: float,
+) -> int:
+    """Time every stage on real and synthetic posts; compare with a baseline.
+
+    Returns 1 if any stage is more than ``threshold`` (a fraction) slower
+    than the baseline, ignoring differences under BENCH_NOISE_MS.
+    """
+    corpora = {p.stem: (p.read_text(), p) for p in posts}
+    tmp = tempfile.TemporaryDirectory()
+    # Synthetic posts get a throwaway project root, so their image index
+    # and caches never touch the site's
+    (Path(tmp.name) / "eleventy.config.js").touch()
+    for scale in scales:
+        post_dir = Path(tmp.name) / f"synthetic_x{scale}"
+        post_dir.mkdir()
+        corpora[f"synthetic_x{scale}"] = (synthetic_post(scale), post_dir / "post.md")
+
+    results: dict[str, dict[str, float]] = {}
+    with tmp:
+        for name, (text, path) in corpora.items():
+            print(f"  {name} ({format_bytes(utf8_len(text))})")
+            results[name] = {
+                stage: round(time_stage(fn, text), 3)
+                for stage, fn in bench_stages(path).items()
+            }
+
+    old = json.loads(baseline.read_text())["results"] if baseline.exists() else {}
+    regressions = 0
+    print(f"\n{'post':<28} {'stage':<26} {'ms':>10} {'baseline':>10} {'change':>8}")
+    for name, stages in results.items():
+        for stage, ms in stages.items():
+            before = old.get(name, {}).get(stage)
+            change = ""
+            flag = ""
+            if before:
+                change = f"{(ms - before) / before:+.0%}"
+                if ms > before * (1 + threshold) and ms - before > BENCH_NOISE_MS:
+                    regressions += 1
+                    flag = "  ✗ slower"
+            base = f"{before:.2f}" if before else "—"
+            print(f"{name:<28.28} {stage:<26} {ms:>10.2f} {base:>10} {change:>8}{flag}")
+
+    if update or not baseline.exists():
+        baseline.write_text(json.dumps({
+            "python": sys.version.split()[0],
+            "platform": sys.platform,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results,
+        }, indent=2) + "\n")
+        print(f"\nBaseline written to: {baseline}")
+    elif regressions:
+        print(f"\n{regressions} stage(s) more than {threshold:.0%} slower than {baseline}")
+    else:
+        print(f"\nNo regressions beyond {threshold:.0%} against {baseline}")
+    return 1 if regressions and not update else 0
+
+
+# ---------------------------------------------------------------------------
+# Golden outputs
+# ---------------------------------------------------------------------------
+
+# Stored dry-run output for every post: <stem>.md and <stem>.html are the
+# Substack markdown and HTML, <stem>.table<N>.csv the CSV each parsed table
+# would upload. --check-golden fails on any byte of difference.
+GOLDEN_DIR = PROJECT_ROOT / "substack_golden"
+
+
+def golden_outputs(post_path: Path) -> dict[str, str]:
+    """Dry-run one post; return its outputs keyed by fixture file name."""
+    text = post_path.read_text()
+    stem = post_path.stem
+    with contextlib.redirect_stdout(io.StringIO()):
+        doc = transform(text, post_path, True)
+        outputs = {f"{stem}.md": doc.markdown(), f"{stem}.html": doc.html()}
+        for num, (*_, table) in enumerate(collect_tables(strip_frontmatter(text)[1]), 1):
+            if table is not None:
+                with contextlib.closing(table):
+                    outputs[f"{stem}.table{num}.csv"] = table.to_csv()
+    return outputs
+
+
+def check_golden(posts: list[Path], update: bool) -> int:
+    """Compare every post's dry-run output with GOLDEN_DIR.
+
+    With ``update``, rewrite the fixtures instead and remove any that no
+    post produces. Returns 1 if any fixture differs, is missing or is stale.
+    """
+    outputs: dict[str, str] = {}
+    for post in posts:
+        outputs.update(golden_outputs(post))
+    stored = {p.name for p in GOLDEN_DIR.glob("*")} if GOLDEN_DIR.exists() else set()
+
+    if update:
+        GOLDEN_DIR.mkdir(exist_ok=True)
+        for name, content in outputs.items():
+            (GOLDEN_DIR / name).write_text(content)
+        for name in stored - outputs.keys():
+            (GOLDEN_DIR / name).unlink()
+        print(f"Wrote {len(outputs)} fixtures for {len(posts)} posts to {GOLDEN_DIR}")
+        return 0
+
+    failures = 0
+    for name, content in outputs.items():
+        if name not in stored:
+            print(f"  ✗ {name}: no fixture")
+        elif (GOLDEN_DIR / name).read_text() != content:
+            print(f"  ✗ {name}: differs")
+        else:
+            continue
+        failures += 1
+    for name in sorted(stored - outputs.keys()):
+        print(f"  ✗ {name}: stale fixture, no post produces it")
+        failures += 1
+    if failures:
+        print(f"\n{failures} of {len(outputs)} outputs don't match {GOLDEN_DIR} (--update-golden to accept)")
+        return 1
+    print(f"All {len(outputs)} outputs of {len(posts)} posts match {GOLDEN_DIR}")
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Development tools for substack_prep.py")
+    parser.add_argument(
+        "posts",
+        nargs="*",
+        metavar="post",
+        help="Path(s) or glob(s) of .md post files for --load-test and --bench (default: all)",
+    )
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument(
+        "--fake-datawrapper",
+        nargs="?",
+        const="127.0.0.1:8766",
+        metavar="ADDRESS",
+        help="Run a local Datawrapper stand-in (point DATAWRAPPER_API at it)",
+    )
+    mode.add_argument(
+        "--load-test",
+        action="store_true",
+        help="Run the given posts singly and in batches against the stand-in",
+    )
+    mode.add_argument(
+        "--check-interrupt",
+        action="store_true",
+        help="Check that Ctrl-C during table uploads cancels the queued ones",
+    )
+    mode.add_argument(
+        "--check-startup",
+        action="store_true",
+        help="Measure import time of the common paths against STARTUP_BUDGET",
+    )
+    mode.add_argument(
+        "--bench",
+        action="store_true",
+        help="Benchmark every stage on the given posts and synthetic posts",
+    )
+    mode.add_argument(
+        "--check-golden",
+        action="store_true",
+        help=f"Diff every post's dry-run markdown, HTML and table CSVs against {GOLDEN_DIR.name}/",
+    )
+    mode.add_argument(
+        "--update-golden",
+        action="store_true",
+        help=f"Rewrite {GOLDEN_DIR.name}/ from the current dry-run output",
+    )
+    parser.add_argument(
+        "--fake-latency",
+        type=float,
+        default=50.0,
+        metavar="MS",
+        help="Stand-in response latency (default: 50)",
+    )
+    parser.add_argument(
+        "--fake-error-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of stand-in requests that fail with 503 (default: 0)",
+    )
+    parser.add_argument(
+        "--fake-429-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of stand-in requests that are rate-limited (default: 0)",
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Worker processes for the load test's batch runs (default: CPU count)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DW_CONCURRENCY,
+        help=f"Parallel Datawrapper uploads per post in the load test (default: {DW_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--bench-scales",
+        type=lambda s: [int(x) for x in s.split(",") if x],
+        default=[10, 100, 1000],
+        metavar="N,N,...",
+        help="Synthetic post sizes in units of SYNTHETIC_UNIT (default: 10,100,1000)",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=BENCH_BASELINE,
+        help=f"Benchmark baseline JSON (default: {BENCH_BASELINE.name}; written if missing)",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Overwrite the benchmark baseline with this run's results",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="Fail --bench if a stage is this fraction slower than baseline (default: 0.25)",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    posts = discover_posts(args.posts, not args.posts)
+
+    if args.check_startup:
+        sys.exit(check_startup())
+
+    if args.check_interrupt:
+        sys.exit(check_interrupt())
+
+    if args.check_golden or args.update_golden:
+        sys.exit(check_golden(discover_posts([], True), args.update_golden))
+
+    if args.bench:
+        print(f"Benchmarking {len(posts)} posts and {len(args.bench_scales)} synthetic sizes...")
+        sys.exit(run_bench(posts, args.bench_scales, args.baseline, args.update_baseline, args.threshold))
+
+    fake = FakeDatawrapper(args.fake_latency, args.fake_error_rate, args.fake_429_rate)
+    if args.load_test:
+        sys.exit(load_test(posts, fake, args.jobs, args.concurrency))
+    print(f"Datawrapper stand-in: export DATAWRAPPER_API={fake.start(args.fake_datawrapper)} (Ctrl-C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()